@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+This file is part of Red Hat Errata Notifications (rhen.py).
+Copyright (C) 2015 Espen Hovind <espehov@ifi.uio.no>
+
+rhen.py is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rhen.py is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
+
+Benchmark of the poll cycle against synthetic feeds served from a local HTTP server.
+Run from the repository root: python3 -m bench.rhen_bench --help
+"""
+import argparse
+import collections
+import configparser
+import datetime
+import functools
+import http.server
+import json
+import logging
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+
+from lib.rhen_db import RHENdb
+from lib.rhen_dbus import RHENDbus
+from lib.rhen_parser import RHENParser
+from lib.rhen_async_parser import RHENAsyncParser
+from lib.rhen_metrics import RHENMetrics
+
+CONFIG = os.getcwd() + '/config/rhen.ini'
+STAGES = collections.OrderedDict([
+    # stage: (component, method)
+    ('poll_cycle', ('parser', 'parse_errata')),
+    ('feed_fetch', ('parser', 'fetch_rss_fead')),
+    ('feed_parse', ('parser', 'parse_rss_fead')),
+    ('find_new', ('parser', 'find_new_erratas')),
+    ('dedup_query', ('db', 'find_new_erratas')),
+    ('dedup_lookup', ('db', 'find_errata')),
+    ('cve_lookup', ('parser', 'fetch_cvss2_score')),
+    ('cve_batch', ('parser', 'get_cvss2_scores')),
+    ('db_write', ('db', 'add_erratas')),
+    ('render', ('dbus', 'construct_message')),
+    ('notify', ('dbus', 'notify')),
+])
+
+def synthetic_cve(n):
+    """ CVE ids with five digit sequence numbers, like most recent ones."""
+    return 'CVE-%d-%d' % (2000 + n // 90000, 10000 + n % 90000)
+
+def synthetic_feed(items, rhsa_ratio, cves_per_advisory, seed=0):
+    """ Return a recent-errata RSS document with items advisories, newest first."""
+    rnd = random.Random(seed)
+    cve = 0
+    entries = []
+    for i in range(items):
+        if rnd.random() < rhsa_ratio:
+            kind = 'RHSA'
+            description = ' '.join(synthetic_cve(cve + c) for c in range(cves_per_advisory))
+            cve += cves_per_advisory
+        else:
+            kind = rnd.choice(['RHBA', 'RHEA'])
+            description = 'Updated packages that fix several bugs are now available.'
+        advisory = '%s-%d:%05d' % (kind, 2000 + i // 100000, i % 100000)
+        entries.append('<item><title>%s-1: Moderate: package%d update</title>'
+                       '<link>https://rhn.redhat.com/errata/%s.html</link>'
+                       '<description>%s</description></item>' %
+                       (advisory, i, advisory.replace(':', '-'), description))
+    return ('<?xml version="1.0"?>\n<rss version="2.0"><channel><title>Recent errata</title>'
+            '%s</channel></rss>' % ''.join(entries)).encode()
+
+def cve_page(cve, padding=0):
+    score = (int(cve[-4:]) % 100) / 10.0
+    return ('<html><head><title>%s</title></head><body><table>'
+            '<tr><th>Impact:</th><td>Moderate</td></tr>'
+            '<tr><th>Base Score:</th><td>%.1f</td></tr></table>'
+            '<div>%s</div></body></html>' % (cve, score, 'x' * padding)).encode()
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves /feed and /cve/<id> with injectable latency."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(max(0, random.gauss(server.latency, server.jitter)))
+        if self.path.startswith('/feed'):
+            body = server.feed
+        elif self.path.startswith('/cve/'):
+            body = cve_page(self.path[len('/cve/'):], server.padding)
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Streaming CVE extraction hangs up once the score is read
+        pass
+
+    def __init__(self, latency, jitter, padding):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.padding = padding
+        self.feed = b''
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, name='stand-in')
+        t.daemon = True
+        t.start()
+
+
+class NullDbus(RHENDbus):
+    """ Renders messages but never talks to the session bus."""
+    def init_notifier(self):
+        return None
+
+    def send(self, summary, description, actions=[], hints={}):
+        pass
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+        self.cpu = collections.defaultdict(list)
+
+    def wrap(self, stage, obj, method):
+        func = getattr(obj, method)
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            cpu = time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                # list.append is atomic, CVE workers may record concurrently.
+                # CPU time of the calling thread approximates how long it held the GIL.
+                self.samples[stage].append(time.perf_counter() - start)
+                self.cpu[stage].append(time.thread_time() - cpu)
+        setattr(obj, method, timed)
+
+    def report(self):
+        stages = collections.OrderedDict()
+        for stage in STAGES:
+            samples = sorted(self.samples.get(stage, []))
+            if not samples:
+                continue
+            total = sum(samples)
+            stages[stage] = {
+                'count': len(samples),
+                'total': total,
+                'throughput': len(samples) / total if total else None,
+                'p50': percentile(samples, 50),
+                'p90': percentile(samples, 90),
+                'p99': percentile(samples, 99),
+                'max': samples[-1],
+                'cpu': sum(self.cpu[stage]),
+            }
+        return stages
+
+def percentile(samples, p):
+    """ Nearest rank percentile of sorted samples."""
+    return samples[max(0, int(round(p / 100.0 * len(samples))) - 1)]
+
+def read_config(args, server, db_path):
+    cfg = configparser.ConfigParser()
+    cfg.read(CONFIG)
+    cfg.set('main', 'errata_rss', server.url + '/feed')
+    cfg.set('main', 'cve_details', server.url + '/cve/')
+    cfg.set('db', 'path', db_path)
+    cfg.set('processor', 'workers', str(args['workers']))
+    cfg.set('processor', 'engine', args['engine'])
+    cfg.set('processor', 'stream_rss', 'yes' if args['stream'] else 'no')
+    cfg.set('processor', 'cve_extractor', args['cve_extractor'])
+    # Hedged requests run on other threads, which hides their CPU time from the cve_lookup stage
+    cfg.set('fetch', 'hedge', 'yes' if args['hedge'] else 'no')
+    return cfg
+
+def run_cycle(cfg, logger, scenario, items):
+    """ Run one instrumented poll cycle against a fresh set of components."""
+    db = RHENdb(cfg, logger)
+    dbus = NullDbus(cfg, logger)
+    engine = RHENAsyncParser if cfg.get('processor', 'engine') == 'asyncio' else RHENParser
+    metrics = RHENMetrics(cfg, logger)
+    parser = engine(cfg, logger, db, dbus, metrics)
+    if scenario == 'warm':
+        parser.parse_errata()
+
+    timer = StageTimer()
+    components = {'parser': parser, 'db': db, 'dbus': dbus}
+    for stage, (component, method) in STAGES.items():
+        timer.wrap(stage, components[component], method)
+
+    # Forget validators and digest, so the unchanged feed short circuit does not skip the cycle
+    for url in parser.errata_feeds:
+        db.update_feed_state(url, None, None, None)
+    cve_bytes = metrics.counters[('rhen_cve_bytes_total', ())]
+    parser.parse_errata()
+    parser.shutdown()
+    db.close()
+    return {'items': items, 'scenario': scenario, 'stages': timer.report(),
+            'cve_bytes': metrics.counters[('rhen_cve_bytes_total', ())] - cve_bytes}
+
+def run(args):
+    logging.basicConfig(level=logging.DEBUG if args['debug'] else logging.CRITICAL)
+    logger = logging.getLogger()
+    server = StandInServer(args['latency'], args['jitter'], args['padding'])
+    server.start()
+
+    results = []
+    for items in args['items']:
+        server.feed = synthetic_feed(items, args['rhsa_ratio'], args['cves'], args['seed'])
+        for scenario in args['scenario']:
+            for r in range(args['rounds']):
+                with tempfile.TemporaryDirectory() as tmp:
+                    cfg = read_config(args, server, os.path.join(tmp, 'erratas.db'))
+                    result = run_cycle(cfg, logger, scenario, items)
+                result['round'] = r
+                results.append(result)
+                cycle = result['stages']['poll_cycle']['total']
+                cve = result['stages'].get('cve_lookup', {}).get('cpu', 0.0)
+                print("{items:>6d} {scenario:<5s} round {round}: {cycle:.3f}s, CVE pages {cve_bytes:.0f} bytes "
+                      "{cve:.3f}s CPU".format(cycle=cycle, cve=cve, **result))
+
+    server.shutdown()
+    return {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'args': args,
+        },
+        'results': results,
+    }
+
+def compare(baseline, current, threshold):
+    """ Print p50 change per stage. Return number of stages slower than threshold."""
+    def index(report):
+        return dict(((r['items'], r['scenario'], r['round']), r['stages']) for r in report['results'])
+
+    regressions = 0
+    old = index(baseline)
+    for key, stages in sorted(index(current).items()):
+        if key not in old:
+            continue
+        for stage, stats in stages.items():
+            if stage not in old[key]:
+                continue
+            ratio = stats['p50'] / old[key][stage]['p50'] if old[key][stage]['p50'] else 1.0
+            flag = ''
+            if ratio > 1 + threshold:
+                flag = 'REGRESSION'
+                regressions += 1
+            print("{0:>6d} {1:<5s} {2:<14s} {3:>8.4f}s -> {4:>8.4f}s {5:>6.2f}x  CPU {6:>8.4f}s -> {7:>8.4f}s {8}".format(
+                key[0], key[1], stage, old[key][stage]['p50'], stats['p50'], ratio,
+                old[key][stage].get('cpu', 0.0), stats.get('cpu', 0.0), flag))
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark rhen.py poll cycle stages.")
+
+    parser.add_argument("--items", type=int, nargs='+', default=[10, 100, 1000, 10000],
+            help="Feed sizes to benchmark (default: 10 100 1000 10000)")
+    parser.add_argument("--rhsa-ratio", type=float, default=0.5, help="Share of RHSA items (default: 0.5)")
+    parser.add_argument("--cves", type=int, default=2, help="CVEs per security advisory (default: 2)")
+    parser.add_argument("--scenario", choices=['cold', 'warm'], nargs='+', default=['cold', 'warm'],
+            help="cold: empty db, warm: every advisory already seen")
+    parser.add_argument("--rounds", type=int, default=1, help="Runs per feed size and scenario")
+    parser.add_argument("--latency", type=float, default=0.01, help="Mean stand-in latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Stand-in latency deviation in seconds")
+    parser.add_argument("--padding", type=int, default=20000, help="Bytes of markup after the CVE score")
+    parser.add_argument("--workers", type=int, default=8, help="CVE workers (default: 8)")
+    parser.add_argument("--engine", choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument("--stream", action='store_true', help="Use streaming RSS parsing")
+    parser.add_argument("--cve-extractor", choices=['stream', 'tree'], default='tree',
+            help="Read CVE pages until the score (stream) or parse whole pages (tree)")
+    parser.add_argument("--hedge", action='store_true', help="Send hedged CVE requests past p95 latency")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default='bench-results.json', help="Write results as JSON")
+    parser.add_argument("--compare", metavar='BASELINE', help="Compare with an earlier results file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+            help="Relative p50 slowdown reported as regression (default: 0.2)")
+    parser.add_argument("--debug", action='store_true', help="Display debug information.")
+
+    return vars(parser.parse_args())
+
+def main(args):
+    report = run(args)
+    with open(args['output'], 'w') as fd:
+        json.dump(report, fd, indent=2)
+    print("Results written to %s" % args['output'])
+
+    if args['compare']:
+        with open(args['compare']) as fd:
+            baseline = json.load(fd)
+        if compare(baseline, report, args['threshold']):
+            raise SystemExit(1)
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -1,4 +1,4 @@
-create table erratas (
+create table if not exists erratas (
     advisory    TEXT        NOT NULL primary key,
     synopsis    TEST        NOT NULL,
     cvss2       REAL,
@@ -0,0 +1,6 @@
+create table if not exists cve_cache (
+    cve         TEXT        NOT NULL primary key,
+    cvss2       REAL        NOT NULL,
+    fetched     TIMESTAMP   NOT NULL,
+    accessed    TIMESTAMP   NOT NULL
+);
@@ -0,0 +1,7 @@
+create table if not exists feed_state (
+    url             TEXT        NOT NULL primary key,
+    etag            TEXT,
+    last_modified   TEXT,
+    digest          TEXT,
+    checked         TIMESTAMP   NOT NULL
+);
@@ -0,0 +1,7 @@
+alter table erratas add column category TEXT;
+update erratas set category = substr(advisory, 1, 4);
+update erratas set cvss2 = NULL where cvss2 = '';
+
+create index if not exists erratas_category_date on erratas (category, date);
+create index if not exists erratas_date on erratas (date);
+create index if not exists erratas_cvss2 on erratas (cvss2);
@@ -0,0 +1,6 @@
+create table if not exists cve_scores (
+    cve         TEXT        NOT NULL primary key,
+    cvss2       REAL,
+    cvss3       REAL,
+    imported    TIMESTAMP   NOT NULL
+);
@@ -0,0 +1,9 @@
+create table if not exists advisory_cve (
+    advisory    TEXT        NOT NULL,
+    cve         TEXT        NOT NULL,
+    cvss2       REAL,
+    primary key (advisory, cve)
+);
+
+create index if not exists advisory_cve_cve on advisory_cve (cve);
+create index if not exists advisory_cve_cvss2 on advisory_cve (cvss2);
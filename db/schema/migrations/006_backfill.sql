@@ -0,0 +1,7 @@
+create table if not exists backfill (
+    path        TEXT        NOT NULL primary key,
+    size        INTEGER     NOT NULL,
+    mtime       REAL        NOT NULL,
+    items       INTEGER     NOT NULL,
+    completed   TIMESTAMP
+);
@@ -0,0 +1,6 @@
+create table if not exists hub_log (
+    seq         INTEGER     primary key autoincrement,
+    advisory    TEXT        NOT NULL,
+    errata      TEXT        NOT NULL,
+    published   TIMESTAMP   NOT NULL
+);
@@ -0,0 +1,20 @@
+create table if not exists rescore (
+    advisory        TEXT        NOT NULL primary key,
+    link            TEXT,
+    severity        INTEGER     NOT NULL default 0,
+    date            TIMESTAMP,
+    attempts        INTEGER     NOT NULL default 0,
+    next_attempt    TIMESTAMP
+);
+
+create index if not exists rescore_priority on rescore (severity desc, date desc);
+
+-- Security advisories stored without a score before the queue existed
+insert or ignore into rescore (advisory, severity, date)
+    select advisory, case
+        when synopsis like 'Critical:%' then 4
+        when synopsis like 'Important:%' then 3
+        when synopsis like 'Moderate:%' then 2
+        when synopsis like 'Low:%' then 1
+        else 0 end, date
+    from erratas where category = 'RHSA' and cvss2 is null;
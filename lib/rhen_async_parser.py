@@ -0,0 +1,184 @@
+"""
+This file is part of Red Hat Errata Notifications (rhen.py).
+Copyright (C) 2015 Espen Hovind <espehov@ifi.uio.no>
+
+rhen.py is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rhen.py is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import asyncio
+import collections
+import configparser
+import time
+import urllib.parse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import lib.rhen_exceptions as RHENExceptions
+from lib.rhen_parser import RHENParser
+
+class RHENAsyncParser(RHENParser):
+    """
+        asyncio variant of RHENParser. The RSS feed and all CVE pages of new erratas
+        are fetched concurrently on one event loop, limited per host by a semaphore.
+        Each errata is stored and notified as soon as its CVEs are resolved.
+    """
+    def __init__(self, cfg, logger, rhen_db, rhen_dbus, rhen_metrics):
+        if aiohttp is None:
+            logger.error("The asyncio engine requires aiohttp")
+            raise SystemExit(1)
+        super().__init__(cfg, logger, rhen_db, rhen_dbus, rhen_metrics)
+        self.host_connections = self.parse_config_async()
+
+    def parse_config_async(self):
+        try:
+            return self.cfg.getint('processor', 'host_connections')
+        except (configparser.Error, ValueError) as err:
+            self.logger.error("Failed parsing config: %s" % err)
+            raise SystemExit(1)
+
+    def init_session(self):
+        # aiohttp sessions are bound to the running loop, one is opened per cycle
+        return None
+
+    def init_executor(self):
+        return None
+
+    def shutdown(self):
+        self.fetch.shutdown()
+
+    def parse_errata(self):
+        """
+            Load RSS feeds and compare with previous erratas. Skip feeds that are unchanged.
+            Return True if any feed changed since last check.
+        """
+        return asyncio.run(self.parse_errata_async())
+
+    async def parse_errata_async(self):
+        self.fetch.start_cycle()
+        self.host_limits = collections.defaultdict(lambda: asyncio.Semaphore(self.host_connections))
+        self.cve_tasks = dict()
+        connector = aiohttp.TCPConnector(limit_per_host=self.host_connections)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            feeds = await self.load_rss_feeds_async(session)
+            if not feeds:
+                return False
+
+            with self.rhen_metrics.timer('rhen_dedup_seconds'):
+                erratas = self.merge_new_erratas(feeds)
+            self.rhen_metrics.inc('rhen_erratas_new_total', len(erratas))
+            self.cve_start = time.time()
+            CVE = set(cve for errata in erratas for cve in errata.get('cve', []))
+            self.cve_scores = self.find_cvss2_scores(CVE)
+            for cve in CVE - set(self.cve_scores):
+                self.cve_tasks[cve] = asyncio.ensure_future(self.fetch_cvss2_score_async(session, cve))
+
+            pending = [self.process_errata_async(errata) for errata in erratas]
+            for finished in asyncio.as_completed(pending):
+                errata = await finished
+                with self.rhen_metrics.timer('rhen_db_write_seconds'):
+                    self.rhen_db.add_erratas([errata])
+                self.rhen_dbus.notify(errata)
+
+        self.cve_cache.put([(cve, task.result()) for cve, task in self.cve_tasks.items()
+                            if task.result() is not None])
+        self.finish_cycle(feeds)
+        return True
+
+    async def process_errata_async(self, errata):
+        """ Wait for the CVEs of one errata and set its max CVSS2 score."""
+        tasks = [self.cve_tasks[cve] for cve in errata.get('cve', []) if cve in self.cve_tasks]
+        await asyncio.gather(*tasks)
+        errata['scores'] = dict((cve, self.cve_tasks[cve].result() if cve in self.cve_tasks
+                                 else self.cve_scores.get(cve)) for cve in errata.get('cve', []))
+        if errata.get('cve'):
+            self.rhen_metrics.observe('rhen_cve_advisory_seconds', time.time() - self.cve_start)
+        cvss2 = [score for score in errata['scores'].values() if score is not None]
+        if cvss2:
+            errata['cvss2'] = max(cvss2)
+        return errata
+
+    def host_limit(self, url):
+        return self.host_limits[urllib.parse.urlsplit(url).netloc]
+
+    async def load_rss_feeds_async(self, session):
+        """ Fetch all due feeds concurrently. Return dict of url -> items of changed feeds."""
+        due = self.due_feeds()
+        pending = [self.fetch_rss_fead_async(session, url, self.rss_validators(url)) for url in due]
+        responses = await asyncio.gather(*pending, return_exceptions=True)
+        return self.parse_rss_feeds(list(zip(due, responses)))
+
+    async def fetch_rss_fead_async(self, session, url, headers):
+        try:
+            self.logger.info("Loading RSS feed %s" % url)
+            with self.rhen_metrics.timer('rhen_feed_fetch_seconds', feed=url):
+                return await self.fetch.get_async(session, url, self.read_rss_fead_async, self.host_limit(url),
+                                                  headers=headers, timeout=self.feed_timeout)
+        except RHENExceptions.FetchFailed as err:
+            self.logger.error("Failed loading rss feed %s: %s" % (url, err))
+            raise RHENExceptions.ParseErrataFailed(err)
+
+    async def read_rss_fead_async(self, response):
+        if response.status == 304:
+            self.logger.info("RSS feed not modified: %s" % response.url)
+            self.rhen_metrics.inc('rhen_feed_unchanged_total')
+            return None
+        self.logger.debug(response.headers)
+        return (response.headers, await response.read())
+
+    async def fetch_cvss2_score_async(self, session, cve):
+        self.rhen_metrics.inc('rhen_cve_requests_total')
+        try:
+            with self.rhen_metrics.timer('rhen_cve_request_seconds'):
+                cvss2 = await self.fetch.get_async(session, self.cve_base + cve, self.read_cvss2_score_async,
+                                                   self.host_limit(self.cve_base), hedge=True)
+        except RHENExceptions.FetchFailed as err:
+            self.logger.error("Failed fetching %s: %s" % (cve, err))
+            cvss2 = None
+        except Exception as err:
+            # One bad page must never end the poll loop
+            self.logger.error("Failed reading %s: %r" % (cve, err))
+            cvss2 = None
+        if cvss2 is None:
+            self.rhen_metrics.inc('rhen_cve_failures_total')
+        return cvss2
+
+    async def read_cvss2_score_async(self, response):
+        try:
+            if self.stream_cve:
+                return await self.stream_cvss2_score_async(response)
+            return self.parse_cvss2_score(await response.text())
+        finally:
+            self.rhen_metrics.inc('rhen_cve_bytes_total', response.content.total_bytes)
+
+    async def stream_cvss2_score_async(self, response):
+        """ Read the CVE page in chunks until the CVSS2 base score is found."""
+        pull = self.cvss2_pull_parser()
+        chunks = response.content.iter_chunked(self.CVE_CHUNK_SIZE)
+        async for chunk in chunks:
+            cvss2 = self.feed_cvss2_score(pull, chunk)
+            if cvss2 is not None:
+                limit = self.cve_drain_limit(response.headers, response.content.total_bytes)
+                if limit:
+                    async for chunk in chunks:
+                        limit -= len(chunk)
+                        if limit < 0:
+                            break
+                if not response.content.at_eof():
+                    # Drop the connection instead of reading the rest of the page
+                    response.close()
+                return cvss2
+        self.logger.error("Failed parsing CVSS2 base score: no Base Score row")
+        return None
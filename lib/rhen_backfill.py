@@ -0,0 +1,148 @@
+"""
+This file is part of Red Hat Errata Notifications (rhen.py).
+Copyright (C) 2015 Espen Hovind <espehov@ifi.uio.no>
+
+rhen.py is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rhen.py is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import datetime
+import email.utils
+import gzip
+import os
+
+from lxml import etree
+
+import lib.rhen_exceptions as RHENExceptions
+
+class RHENBackfill(object):
+    """
+        Import archived errata RSS/XML dumps without notifications. Items are parsed
+        one at a time, and new erratas are scored and stored batch_size at a time.
+        Each stored batch is checkpointed, so an interrupted backfill resumes
+        after the last batch. A dump that changed since its checkpoint starts over.
+    """
+    EXTENSIONS = ('.xml', '.rss', '.xml.gz', '.rss.gz')
+
+    def __init__(self, cfg, logger, rhen_db, rhen_parser):
+        self.cfg = cfg
+        self.logger = logger
+        self.rhen_db = rhen_db
+        self.rhen_parser = rhen_parser
+        self.batch_size = self.parse_config()
+
+    def parse_config(self):
+        try:
+            return self.cfg.getint('backfill', 'batch_size', fallback=500)
+        except ValueError as err:
+            self.logger.error("Failed parsing config: %s" % err)
+            raise SystemExit(1)
+
+    def dumps(self, path):
+        """ Return path, or the dumps in directory path in name order."""
+        if not os.path.isdir(path):
+            return [path]
+        return [os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.endswith(self.EXTENSIONS)]
+
+    def run(self, path):
+        """ Backfill every dump in path. Return number of erratas stored."""
+        stored = 0
+        for dump in self.dumps(path):
+            stored += self.backfill(os.path.abspath(dump))
+        return stored
+
+    def backfill(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError as err:
+            self.logger.error("Failed reading %s: %s" % (path, err))
+            raise RHENExceptions.ImportFailed(err)
+
+        checkpoint = self.rhen_db.find_backfill(path)
+        skip = 0
+        if checkpoint and checkpoint[:2] == (stat.st_size, stat.st_mtime):
+            if checkpoint[3] is not None:
+                self.logger.info("Already backfilled %s" % path)
+                return 0
+            skip = checkpoint[2]
+            self.logger.info("Resuming backfill of %s after %d items" % (path, skip))
+        else:
+            self.logger.info("Backfilling %s" % path)
+
+        stored = 0
+        items = 0
+        batch = []
+        for errata_item in self.iterparse(path):
+            items += 1
+            if items <= skip:
+                continue
+            errata = self.parse_item(errata_item)
+            if errata:
+                batch.append(errata)
+            if len(batch) == self.batch_size:
+                stored += self.store(batch)
+                self.rhen_db.update_backfill(path, stat.st_size, stat.st_mtime, items)
+                batch = []
+        stored += self.store(batch)
+        self.rhen_db.update_backfill(path, stat.st_size, stat.st_mtime, items, datetime.datetime.now())
+        self.logger.info("Backfilled %d new erratas from %d items in %s" % (stored, items, path))
+        return stored
+
+    def iterparse(self, path):
+        """ Yield each item of a dump as it is read, and free it once processed."""
+        opener = gzip.open if path.endswith('.gz') else open
+        try:
+            with opener(path, 'rb') as fd:
+                for event, errata_item in etree.iterparse(fd, tag='item', recover=True):
+                    yield errata_item
+                    errata_item.clear()
+                    while errata_item.getprevious() is not None:
+                        del errata_item.getparent()[0]
+        except (IOError, etree.XMLSyntaxError) as err:
+            self.logger.error("Failed parsing %s: %s" % (path, err))
+            raise RHENExceptions.ImportFailed(err)
+
+    def parse_item(self, errata_item):
+        try:
+            advisory = self.rhen_parser.parse_errata_advisory(errata_item.findtext('title'))
+            errata = self.rhen_parser.parse_errata_content(advisory, errata_item)
+        except (AttributeError, TypeError):
+            self.logger.error("Skipping item without errata title: %s" % errata_item.findtext('title'))
+            return None
+        published = errata_item.findtext('pubDate')
+        if published:
+            try:
+                # Stored like other dates, in local time without zone
+                errata['date'] = email.utils.parsedate_to_datetime(published).astimezone().replace(tzinfo=None)
+            except (TypeError, ValueError):
+                self.logger.debug("Unparsable pubDate of %s: %s" % (advisory, published))
+        return errata
+
+    def store(self, batch):
+        """
+            Score new erratas of batch with parallel CVE lookups, and store them in one
+            transaction. Raise ImportFailed if they could not be stored.
+        """
+        erratas = dict((errata['advisory'], errata) for errata in batch)
+        if not erratas:
+            return 0
+        try:
+            new = self.rhen_db.find_new_erratas(list(erratas))
+            erratas = [errata for advisory, errata in erratas.items() if advisory in new]
+            self.rhen_parser.score_erratas(erratas)
+            # The batch is only checkpointed once committed
+            if erratas and not self.rhen_db.add_erratas(erratas):
+                raise RHENExceptions.ImportFailed("Failed storing %d erratas" % len(erratas))
+        except RHENExceptions.ParseErrataFailed as err:
+            raise RHENExceptions.ImportFailed(err)
+        return len(erratas)
@@ -0,0 +1,68 @@
+"""
+This file is part of Red Hat Errata Notifications (rhen.py).
+Copyright (C) 2015 Espen Hovind <espehov@ifi.uio.no>
+
+rhen.py is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rhen.py is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import datetime
+import configparser
+
+class RHENCveCache(object):
+    """
+        Persistent CVE -> CVSS2 cache stored in the cve_cache table.
+        Entries older than ttl seconds are ignored and evicted. When the cache
+        grows beyond max_entries, the least recently accessed entries are evicted.
+    """
+    def __init__(self, cfg, logger, rhen_db):
+        self.cfg = cfg
+        self.logger = logger
+        self.rhen_db = rhen_db
+        self.ttl, self.max_entries = self.parse_config()
+        self.hits = 0
+        self.misses = 0
+
+    def parse_config(self):
+        try:
+            ttl = self.cfg.getint('cve_cache', 'ttl')
+            max_entries = self.cfg.getint('cve_cache', 'max_entries')
+            return (ttl, max_entries)
+        except (configparser.Error, ValueError) as err:
+            self.logger.error("Failed parsing config: %s" % err)
+            raise SystemExit(1)
+
+    def expiry(self):
+        return datetime.datetime.now() - datetime.timedelta(seconds=self.ttl)
+
+    def get(self, CVE):
+        """ Return dict of cached CVSS2 scores. Missing or expired CVEs are left out."""
+        CVE = set(CVE)
+        scores = self.rhen_db.find_cve_scores(CVE, self.expiry()) if CVE else dict()
+        self.hits += len(scores)
+        self.misses += len(CVE) - len(scores)
+        return scores
+
+    def put(self, scores):
+        """ Cache (cve, cvss2) pairs."""
+        if scores:
+            self.rhen_db.add_cve_scores(scores)
+
+    def evict(self):
+        expired, evicted = self.rhen_db.evict_cve_scores(self.expiry(), self.max_entries)
+        self.logger.debug("CVE cache evicted %d expired and %d old entries" % (expired, evicted))
+
+    def log_stats(self):
+        """ Log hit/miss counters for this poll and reset them."""
+        self.logger.info("CVE cache: %d hits, %d misses" % (self.hits, self.misses))
+        self.hits = 0
+        self.misses = 0
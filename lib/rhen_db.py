@@ -16,46 +16,138 @@ You should have received a copy of the GNU General Public License
 along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
 """
 import os
+import re
 import sqlite3
 import datetime
+import threading
 import configparser
 
 import lib.rhen_exceptions as RHENExceptions
+from lib.rhen_index import RHENIndex
 
 class RHENdb(object):
+    """
+        Errata store. The db runs in WAL mode and every thread gets its own connection,
+        so readers (--list, workers) and the daemon writing never block each other.
+        The schema is db/schema/erratas.sql followed by the numbered migrations.
+    """
+    # Rescore queue priority of security advisories, from the impact in their synopsis
+    SEVERITIES = {'Low': 1, 'Moderate': 2, 'Important': 3, 'Critical': 4}
+
     def __init__(self, cfg, logger):
         self.logger = logger
         self.cfg = cfg
-        self.db_path, self.db_schema = self.parse_config()
-        self.conn, self.cursor = self.init_db()
+        (self.db_path, self.db_schema, self.db_migrations,
+         self.busy_timeout, self.synchronous, self.cache_size) = self.parse_config()
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.index_lock = threading.Lock()
+        self.advisory_index = None
+        self.init_db()
 
     def parse_config(self):
         try:
-            return (self.cfg.get('db', 'path'), self.cfg.get('db', 'schema'))
-        except configparser.Error as err:
+            return (self.cfg.get('db', 'path'), self.cfg.get('db', 'schema'),
+                    self.cfg.get('db', 'migrations'),
+                    self.cfg.getint('db', 'busy_timeout', fallback=5000),
+                    self.cfg.get('db', 'synchronous', fallback='NORMAL'),
+                    self.cfg.getint('db', 'cache_size', fallback=-8000))
+        except (configparser.Error, ValueError) as err:
             self.logger.error("Failed parsing config: %s" % err)
             raise SystemExit(1)
 
     def init_db(self):
-        """ Connect to db. If not existing, create first."""
+        """ If db is not existing, create first. Then bring schema up to date."""
         try:
             self.check()
         except RHENExceptions.DBNotFound as err:
             self.logger.info("Initializing db: %s" % err)
-            self.create()
         finally:
-            return self.connect()
+            self.create()
+
+    @property
+    def index(self):
+        """
+            Advisory index, built on first use so commands that never look up advisories
+            skip reading them. Raise ParseErrataFailed if it cannot be built.
+        """
+        with self.index_lock:
+            if self.advisory_index is None:
+                index = RHENIndex(self.cfg, self.logger)
+                if not self.load_index(index):
+                    raise RHENExceptions.ParseErrataFailed("Failed loading advisory index")
+                self.advisory_index = index
+        return self.advisory_index
+
+    def load_index(self, index):
+        """
+            Fill index with every advisory in db, most recent last. Return False if the db
+            fails, leaving index as it was.
+        """
+        try:
+            # Rows stored while loading are added again by sync_index, which is harmless
+            rowid = self.conn.execute("select coalesce(max(rowid), 0) from erratas").fetchone()[0]
+            count = self.conn.execute("select count(*) from erratas").fetchone()[0]
+            index.load(count, (advisory for advisory, in self.conn.execute(
+                "select advisory from erratas order by date")), rowid)
+            return True
+        except sqlite3.Error as err:
+            self.logger.error("Failed loading advisory index: %s" % err)
+            return False
+
+    def sync_index(self):
+        """
+            Return the index, with the advisories stored since it was loaded added, by this or
+            another process. Erratas are never deleted, so new rows have larger rowids.
+        """
+        index = self.index
+        try:
+            index.sync(self.conn.execute("select rowid, advisory from erratas where rowid > ? order by rowid",
+                                         (index.rowid,)).fetchall())
+        except sqlite3.Error as err:
+            self.logger.error("Failed updating advisory index: %s" % err)
+            raise RHENExceptions.ParseErrataFailed(err)
+        if index.full():
+            self.load_index(index)
+        return index
 
     def create(self):
         try:
             conn = sqlite3.connect(self.db_path)
+            conn.execute("pragma journal_mode = WAL")
             with open(self.db_schema, 'rt') as fd:
                 conn.executescript(fd.read())
-                conn.commit()
-        except sqlite3.OperationalError as err:
+            self.migrate(conn)
+            conn.close()
+        except (sqlite3.Error, IOError) as err:
             self.logger.error("Failed to initalize db: %s" % err)
             raise SystemExit(1)
 
+    def migrations(self):
+        """ Return sorted (version, path) of migration files named NNN_description.sql."""
+        migrations = []
+        for name in os.listdir(self.db_migrations):
+            match = re.match(r'^(\d+)_.*\.sql$', name)
+            if match:
+                migrations.append((int(match.group(1)), os.path.join(self.db_migrations, name)))
+        return sorted(migrations)
+
+    def migrate(self, conn):
+        """ Apply each migration newer than the db, in its own transaction."""
+        version = conn.execute("pragma user_version").fetchone()[0]
+        for migration, path in self.migrations():
+            if migration <= version:
+                continue
+            self.logger.info("Migrating db to version %d: %s" % (migration, path))
+            with open(path, 'rt') as fd:
+                script = fd.read()
+            try:
+                conn.executescript("begin;\n%s;\npragma user_version = %d;\ncommit;" % (script, migration))
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+
     def check(self):
         """ Check that db actually exists """
         try:
@@ -65,35 +157,408 @@ class RHENdb(object):
 
     def connect(self):
         try:
-            conn = sqlite3.connect(self.db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+            conn = sqlite3.connect(self.db_path, detect_types=sqlite3.PARSE_DECLTYPES,
+                                   check_same_thread=False)
+            conn.execute("pragma busy_timeout = %d" % self.busy_timeout)
+            conn.execute("pragma synchronous = %s" % self.synchronous)
+            conn.execute("pragma cache_size = %d" % self.cache_size)
             cursor = conn.cursor()
             return (conn, cursor)
         except sqlite3.Error as err:
             self.logger.error("Failed connecting to db: %s" % err)
             raise SystemExit(1)
 
+    def local_connection(self):
+        """ Return (conn, cursor) of the calling thread, connecting on first use."""
+        if not hasattr(self.local, 'conn'):
+            self.local.conn, self.local.cursor = self.connect()
+            with self.lock:
+                self.connections.append(self.local.conn)
+        return (self.local.conn, self.local.cursor)
+
+    @property
+    def conn(self):
+        return self.local_connection()[0]
+
+    @property
+    def cursor(self):
+        return self.local_connection()[1]
+
+    def release(self):
+        """ Close the connection of the calling thread. Short-lived threads call this before exiting."""
+        local = self.local
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            return
+        with self.lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+        conn.close()
+        del local.conn, local.cursor
+
+    def close(self):
+        """ Close the connections of all threads."""
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
+
     def add_errata(self, errata):
-        self.logger.info("Adding errata: %s", errata)
+        return self.add_erratas([errata])
+
+    def add_erratas(self, erratas):
+        """
+            Insert all erratas in a single transaction. Return True once committed, False if
+            rejected by a constraint. Raise ParseErrataFailed if the db fails.
+        """
+        for errata in erratas:
+            self.logger.info("Adding errata: %s", errata)
         try:
             # Commit if success. Rollback if any exceptions.
             with self.conn:
-                self.cursor.execute("""
-                    insert into erratas (advisory, synopsis, cvss2, date) values (?, ?, ?, ?)""",
-                    (errata['advisory'], errata['synopsis'], errata.get('cvss2', ''),
-                    datetime.datetime.now()))
+                now = datetime.datetime.now()
+                self.cursor.executemany("""
+                    insert or ignore into erratas (advisory, synopsis, cvss2, date, category)
+                    values (?, ?, ?, ?, ?)""",
+                    [(errata['advisory'], errata['synopsis'], errata.get('cvss2'), errata.get('date', now),
+                      errata['advisory'].split('-')[0]) for errata in erratas])
+                if self.cursor.rowcount < len(erratas):
+                    self.logger.error("Skipped %d erratas already in db" % (len(erratas) - self.cursor.rowcount))
+                self.cursor.executemany("""
+                    insert or replace into advisory_cve (advisory, cve, cvss2) values (?, ?, ?)""",
+                    [(errata['advisory'], cve, errata.get('scores', {}).get(cve))
+                     for errata in erratas for cve in errata.get('cve', [])])
+                self.cursor.executemany("""
+                    insert or ignore into rescore (advisory, link, severity, date) values (?, ?, ?, ?)""",
+                    [(errata['advisory'], errata.get('link'), self.severity(errata['synopsis']),
+                      errata.get('date', now)) for errata in erratas if self.unscored(errata)])
         except sqlite3.IntegrityError as err:
-            self.logger.error("Failed adding %s to db: %s" % (errata['advisory'], err))
+            self.logger.error("Failed adding %d erratas to db: %s" % (len(erratas), err))
+            return False
+        except sqlite3.Error as err:
+            # Fail the cycle before its erratas are notified and its feeds marked as seen
+            self.logger.error("Failed adding %d erratas to db: %s" % (len(erratas), err))
+            raise RHENExceptions.ParseErrataFailed(err)
+        # An index not built yet reads these from the db when it is
+        if self.advisory_index is not None:
+            self.advisory_index.add(errata['advisory'] for errata in erratas)
+            if self.advisory_index.full():
+                self.load_index(self.advisory_index)
+        return True
+
+    def severity(self, synopsis):
+        return self.SEVERITIES.get((synopsis or '').split(':')[0], 0)
+
+    def unscored(self, errata):
+        """ Return True if errata is a security advisory without CVEs, or with CVEs not scored."""
+        if 'RHSA' not in errata['advisory']:
+            return False
+        scores = errata.get('scores', {})
+        return not errata.get('cve') or any(scores.get(cve) is None for cve in errata['cve'])
 
     def find_errata(self, advisory):
+        index = self.sync_index()
+        known = index.lookup(advisory)
+        if known is not None:
+            return (advisory,) if known else None
         try:
             self.cursor.execute("select advisory from erratas where advisory = (?)", (advisory,))
-            return self.cursor.fetchone()
+            row = self.cursor.fetchone()
+            index.found(advisory, row is not None)
+            return row
         except sqlite3.Error as err:
             self.logger.error("Advisory not found %s: %s" % (advisory, err))
 
-    def list_all(self):
+    def find_new_erratas(self, advisories, chunk_size=500):
+        """
+            Return the set of advisories not in db. The index answers most, the ones the
+            Bloom filter may contain are looked up with one query per chunk of advisories.
+        """
+        index = self.sync_index()
+        seen = set()
+        unknown = []
+        for advisory in set(advisories):
+            known = index.lookup(advisory)
+            if known:
+                seen.add(advisory)
+            elif known is None:
+                unknown.append(advisory)
+        try:
+            for i in range(0, len(unknown), chunk_size):
+                chunk = unknown[i:i + chunk_size]
+                self.cursor.execute("select advisory from erratas where advisory in (%s)" %
+                    ','.join('?' * len(chunk)), chunk)
+                seen.update(advisory for advisory, in self.cursor)
+        except sqlite3.Error as err:
+            self.logger.error("Failed looking up advisories: %s" % err)
+            raise RHENExceptions.ParseErrataFailed(err)
+        for advisory in unknown:
+            index.found(advisory, advisory in seen)
+        return set(advisories) - seen
+
+    def list_erratas(self, category=None, since=None, min_cvss=None, limit=None):
+        """ Yield (advisory, synopsis, cvss2, date) newest first, filtered in SQL."""
+        where = []
+        params = []
+        if category:
+            where.append("category = ?")
+            params.append(category)
+        if since:
+            where.append("date >= ?")
+            params.append(since)
+        if min_cvss is not None:
+            where.append("cvss2 >= ?")
+            params.append(min_cvss)
+
+        query = "select advisory, synopsis, cvss2, date from erratas"
+        if where:
+            query += " where " + " and ".join(where)
+        query += " order by date desc"
+        if limit:
+            query += " limit ?"
+            params.append(limit)
+
+        try:
+            # Own cursor, so rows stream while other queries run
+            yield from self.conn.execute(query, params)
+        except sqlite3.Error as err:
+            self.logger.error("List erratas failed: %s" % err)
+
+    def list_advisory_cves(self, cve=None, min_score=None, limit=None):
+        """ Yield (advisory, cve, cvss2, synopsis, date) of advisories fixing cve, or CVEs scored min_score or more."""
+        where = []
+        params = []
+        if cve:
+            where.append("advisory_cve.cve = ?")
+            params.append(cve)
+        if min_score is not None:
+            where.append("advisory_cve.cvss2 >= ?")
+            params.append(min_score)
+
+        query = """
+            select erratas.advisory, advisory_cve.cve, advisory_cve.cvss2, erratas.synopsis, erratas.date
+            from advisory_cve join erratas on erratas.advisory = advisory_cve.advisory"""
+        if where:
+            query += " where " + " and ".join(where)
+        query += " order by advisory_cve.cvss2 desc, erratas.date desc"
+        if limit:
+            query += " limit ?"
+            params.append(limit)
+
+        try:
+            yield from self.conn.execute(query, params)
+        except sqlite3.Error as err:
+            self.logger.error("List advisory CVEs failed: %s" % err)
+
+    def recompute_scores(self):
+        """
+            Refresh CVE scores of advisories from imported data and the CVE cache, then set
+            each advisory's CVSS2 score to the max of its CVEs. Return number of erratas changed.
+        """
+        try:
+            with self.conn:
+                self.cursor.execute("""
+                    update advisory_cve set cvss2 = coalesce(
+                        (select cvss2 from cve_scores where cve_scores.cve = advisory_cve.cve),
+                        (select cvss2 from cve_cache where cve_cache.cve = advisory_cve.cve),
+                        cvss2)""")
+                self.cursor.execute("""
+                    update erratas set cvss2 = (
+                        select max(cvss2) from advisory_cve where advisory_cve.advisory = erratas.advisory)
+                    where cvss2 is not (
+                        select max(cvss2) from advisory_cve where advisory_cve.advisory = erratas.advisory)
+                    and exists (
+                        select 1 from advisory_cve
+                        where advisory_cve.advisory = erratas.advisory and cvss2 is not null)""")
+                return self.cursor.rowcount
+        except sqlite3.Error as err:
+            self.logger.error("Failed recomputing scores: %s" % err)
+            return 0
+
+    def find_cve_scores(self, CVE, fetched_after):
+        """ Return dict of cached CVSS2 scores fetched after timestamp. Mark hits as accessed."""
+        try:
+            placeholders = ','.join('?' * len(CVE))
+            self.cursor.execute("""
+                select cve, cvss2 from cve_cache where fetched >= ? and cve in (%s)""" % placeholders,
+                [fetched_after] + list(CVE))
+            scores = dict(self.cursor.fetchall())
+            with self.conn:
+                now = datetime.datetime.now()
+                self.cursor.executemany("update cve_cache set accessed = ? where cve = ?",
+                    [(now, cve) for cve in scores])
+            return scores
+        except sqlite3.Error as err:
+            self.logger.error("Failed looking up cached CVEs: %s" % err)
+            return dict()
+
+    def add_cve_scores(self, scores):
+        """ Store (cve, cvss2) pairs in the CVE cache, replacing stale entries."""
+        try:
+            with self.conn:
+                now = datetime.datetime.now()
+                self.cursor.executemany("""
+                    insert or replace into cve_cache (cve, cvss2, fetched, accessed)
+                    values (?, ?, ?, ?)""", [(cve, cvss2, now, now) for cve, cvss2 in scores])
+        except sqlite3.Error as err:
+            self.logger.error("Failed caching CVE scores: %s" % err)
+
+    def evict_cve_scores(self, fetched_before, max_entries):
+        """ Drop expired entries, then least recently accessed entries above max_entries."""
         try:
-            self.cursor.execute("select * from erratas order by date desc")
+            with self.conn:
+                self.cursor.execute("delete from cve_cache where fetched < ?", (fetched_before,))
+                expired = self.cursor.rowcount
+                self.cursor.execute("""
+                    delete from cve_cache where cve not in (
+                        select cve from cve_cache order by accessed desc limit ?)""",
+                    (max_entries,))
+                return (expired, self.cursor.rowcount)
+        except sqlite3.Error as err:
+            self.logger.error("Failed evicting CVE cache: %s" % err)
+            return (0, 0)
+
+    def find_feed_state(self, url):
+        """ Return (etag, last_modified, digest) from the last check of feed url."""
+        try:
+            self.cursor.execute("""
+                select etag, last_modified, digest from feed_state where url = ?""", (url,))
+            return self.cursor.fetchone() or (None, None, None)
+        except sqlite3.Error as err:
+            self.logger.error("Failed looking up feed state %s: %s" % (url, err))
+            return (None, None, None)
+
+    def update_feed_state(self, url, etag, last_modified, digest):
+        try:
+            with self.conn:
+                self.cursor.execute("""
+                    insert or replace into feed_state (url, etag, last_modified, digest, checked)
+                    values (?, ?, ?, ?, ?)""",
+                    (url, etag, last_modified, digest, datetime.datetime.now()))
+        except sqlite3.Error as err:
+            self.logger.error("Failed updating feed state %s: %s" % (url, err))
+
+    def add_imported_cve_scores(self, rows):
+        """ Store (cve, cvss2, cvss3) rows from a bulk import. Return number of rows stored."""
+        try:
+            with self.conn:
+                now = datetime.datetime.now()
+                self.cursor.executemany("""
+                    insert or replace into cve_scores (cve, cvss2, cvss3, imported)
+                    values (?, ?, ?, ?)""", [(cve, cvss2, cvss3, now) for cve, cvss2, cvss3 in rows])
+                return len(rows)
+        except sqlite3.Error as err:
+            self.logger.error("Failed importing CVE scores: %s" % err)
+            raise RHENExceptions.ImportFailed(err)
+
+    def find_imported_cve_scores(self, CVE, chunk_size=500):
+        """ Return dict of CVSS2 scores of CVEs found in imported data."""
+        CVE = list(CVE)
+        scores = dict()
+        try:
+            for i in range(0, len(CVE), chunk_size):
+                chunk = CVE[i:i + chunk_size]
+                self.cursor.execute("""
+                    select cve, cvss2 from cve_scores where cvss2 is not null and cve in (%s)""" %
+                    ','.join('?' * len(chunk)), chunk)
+                scores.update(self.cursor.fetchall())
+        except sqlite3.Error as err:
+            self.logger.error("Failed looking up imported CVEs: %s" % err)
+        return scores
+
+    def find_backfill(self, path):
+        """ Return (size, mtime, items, completed) of the last backfill of path, or None."""
+        try:
+            self.cursor.execute("""
+                select size, mtime, items, completed from backfill where path = ?""", (path,))
+            return self.cursor.fetchone()
+        except sqlite3.Error as err:
+            self.logger.error("Failed looking up backfill %s: %s" % (path, err))
+            return None
+
+    def update_backfill(self, path, size, mtime, items, completed=None):
+        """ Checkpoint that the first items of path are imported."""
+        try:
+            with self.conn:
+                self.cursor.execute("""
+                    insert or replace into backfill (path, size, mtime, items, completed)
+                    values (?, ?, ?, ?, ?)""", (path, size, mtime, items, completed))
+        except sqlite3.Error as err:
+            self.logger.error("Failed updating backfill %s: %s" % (path, err))
+            raise RHENExceptions.ImportFailed(err)
+
+    def add_hub_log(self, advisory, errata, retention):
+        """ Append JSON encoded errata to the hub log, keeping the last retention entries. Return its seq."""
+        try:
+            with self.conn:
+                self.cursor.execute("""
+                    insert into hub_log (advisory, errata, published) values (?, ?, ?)""",
+                    (advisory, errata, datetime.datetime.now()))
+                seq = self.cursor.lastrowid
+                self.cursor.execute("delete from hub_log where seq <= ?", (seq - retention,))
+                return seq
+        except sqlite3.Error as err:
+            self.logger.error("Failed logging %s for hub: %s" % (advisory, err))
+            return None
+
+    def find_hub_log(self, after):
+        """ Yield (seq, errata) of hub log entries after seq."""
+        try:
+            yield from self.conn.execute("""
+                select seq, errata from hub_log where seq > ? order by seq""", (after,))
+        except sqlite3.Error as err:
+            self.logger.error("Failed reading hub log: %s" % err)
+
+    def find_rescore(self, limit):
+        """ Return (advisory, link, attempts) of queued advisories due for a retry, most severe and newest first."""
+        try:
+            self.cursor.execute("""
+                select advisory, link, attempts from rescore
+                where next_attempt is null or next_attempt <= ?
+                order by severity desc, date desc limit ?""", (datetime.datetime.now(), limit))
             return self.cursor.fetchall()
         except sqlite3.Error as err:
-            self.logger.error("List all erratas failed: %s" % err)
+            self.logger.error("Failed reading rescore queue: %s" % err)
+            return []
+
+    def count_rescore(self):
+        try:
+            return self.conn.execute("select count(*) from rescore").fetchone()[0]
+        except sqlite3.Error as err:
+            self.logger.error("Failed reading rescore queue: %s" % err)
+            return 0
+
+    def find_advisory_scores(self, advisory):
+        """ Return dict of CVE -> stored CVSS2 score of advisory, None if not scored."""
+        try:
+            self.cursor.execute("select cve, cvss2 from advisory_cve where advisory = ?", (advisory,))
+            return dict(self.cursor.fetchall())
+        except sqlite3.Error as err:
+            self.logger.error("Failed looking up CVEs of %s: %s" % (advisory, err))
+            return dict()
+
+    def update_rescore(self, advisory, scores, next_attempt):
+        """
+            Store the CVE scores of advisory and set its CVSS2 score to their max. Queue
+            advisory for another attempt at next_attempt, or drop it from the queue if None.
+            Raise RescoreFailed if the db fails.
+        """
+        try:
+            with self.conn:
+                self.cursor.executemany("""
+                    insert or replace into advisory_cve (advisory, cve, cvss2) values (?, ?, ?)""",
+                    [(advisory, cve, cvss2) for cve, cvss2 in scores.items()])
+                self.cursor.execute("""
+                    update erratas set cvss2 = (
+                        select max(cvss2) from advisory_cve where advisory_cve.advisory = erratas.advisory)
+                    where advisory = ?""", (advisory,))
+                if next_attempt is None:
+                    self.cursor.execute("delete from rescore where advisory = ?", (advisory,))
+                else:
+                    self.cursor.execute("""
+                        update rescore set attempts = attempts + 1, next_attempt = ?
+                        where advisory = ?""", (next_attempt, advisory))
+        except sqlite3.Error as err:
+            self.logger.error("Failed updating score of %s: %s" % (advisory, err))
+            raise RHENExceptions.RescoreFailed(err)
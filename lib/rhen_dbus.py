@@ -18,7 +18,7 @@ along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
 import dbus
 import jinja2
 import configparser
-import time
+import os
 
 class RHENDbus(object):
     def __init__(self, cfg, logger):
@@ -26,6 +26,9 @@ class RHENDbus(object):
         self.logger = logger
         self.item, self.path, self.interface = self.parse_config()
         self.notifier = self.init_notifier()
+        self.env = self.init_templates()
+        self.templates = dict((name, self.env.get_template(name))
+                              for name in ('notification.jin', 'digest.jin'))
 
     def parse_config(self):
         try:
@@ -45,11 +48,30 @@ class RHENDbus(object):
         except dbus.exceptions.DBusException as err:
             self.logger.error("Failed dbus setup: %s" % err)
 
+    def init_templates(self):
+        """ Compiled templates are kept for the lifetime of the notifier, optionally cached on disk."""
+        bytecode_cache = None
+        cache_dir = self.cfg.get('templates', 'bytecode_cache', fallback='')
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+        return jinja2.Environment(loader=jinja2.PackageLoader('rhen', 'templates'),
+                                  bytecode_cache=bytecode_cache, auto_reload=True)
+
+    def get_template(self, template_name):
+        """ Return compiled template. Recompile only if the template file changed."""
+        template = self.templates.get(template_name)
+        if template is None or not template.is_up_to_date:
+            template = self.env.get_template(template_name)
+            self.templates[template_name] = template
+        return template
+
     def notify(self, errata):
         # Construct notfication message (summary + message)
         message = self.construct_message(errata)
-        summary = message.splitlines()[0]
-        description = '\r'.join(message.splitlines()[1:])
+        if message is None:
+            return
+        summary, description = message
 
         # Require user to acknowledge Security Advisories
         if 'cvss2' in errata.keys():
@@ -59,11 +81,26 @@ class RHENDbus(object):
         else:
             self.send(summary, description)
 
-    def construct_message(self, data):
+    def notify_digest(self, erratas):
+        """ Collapse several erratas into one notification, highest CVSS2 score first."""
+        erratas = sorted(erratas, key=lambda errata: errata.get('cvss2') or 0, reverse=True)
+        message = self.construct_message(erratas, 'digest.jin')
+        if message is None:
+            return
+        summary, description = message
+
+        if any('cvss2' in errata.keys() for errata in erratas):
+            hints = {'urgency': 2}
+            actions = ['0', 'Acknowledge']
+            self.send(summary, description, actions, hints)
+        else:
+            self.send(summary, description)
+
+    def construct_message(self, data, template_name='notification.jin'):
+        """ Render template and return (summary, description)."""
         try:
-            env = jinja2.Environment(loader=jinja2.PackageLoader('rhen', 'templates'))
-            template = env.get_template('notification.jin')
-            return template.render(data=data)
+            summary, _, description = self.get_template(template_name).render(data=data).partition('\n')
+            return (summary, '\r'.join(description.splitlines()))
         except jinja2.TemplateError as err:
             self.logger.error("Failed constructing message: %s" % err)
 
@@ -76,7 +113,5 @@ class RHENDbus(object):
                                  self.cfg.get('dbus', 'app_icon'),
                                  summary, description,
                                  actions, hints, self.cfg.getint('dbus', 'timeout'))
-            # throttle notifications
-            time.sleep(2)
         except dbus.exceptions.DBusException as err:
             self.logger.error("Failed sending notification: %s" % err)
@@ -0,0 +1,125 @@
+"""
+This file is part of Red Hat Errata Notifications (rhen.py).
+Copyright (C) 2015 Espen Hovind <espehov@ifi.uio.no>
+
+rhen.py is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rhen.py is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import configparser
+import queue
+import threading
+import time
+
+class RHENDispatcher(object):
+    """
+        Send notifications from a dedicated thread, so parsing and db writes never
+        wait on the desktop. Notifications are throttled by a token bucket. When more
+        than digest_threshold erratas are pending, they are sent as one digest.
+    """
+    def __init__(self, cfg, logger, rhen_dbus, rhen_metrics):
+        self.cfg = cfg
+        self.logger = logger
+        self.rhen_dbus = rhen_dbus
+        self.rhen_metrics = rhen_metrics
+        self.rate, self.burst, self.digest_threshold, self.collect_delay = self.parse_config()
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.idle = threading.Event()
+        self.rhen_metrics.callback('rhen_notification_queue_depth', self.queue.qsize)
+        self.stopped = threading.Event()
+        self.thread = self.init_thread()
+
+    def parse_config(self):
+        try:
+            rate = self.cfg.getfloat('dispatcher', 'rate')
+            burst = self.cfg.getint('dispatcher', 'burst')
+            digest_threshold = self.cfg.getint('dispatcher', 'digest_threshold')
+            collect_delay = self.cfg.getfloat('dispatcher', 'collect_delay')
+            return (rate, burst, digest_threshold, collect_delay)
+        except (configparser.Error, ValueError) as err:
+            self.logger.error("Failed parsing config: %s" % err)
+            raise SystemExit(1)
+
+    def init_thread(self):
+        t = threading.Thread(target=self.dispatch, name='dispatcher')
+        t.daemon = True
+        t.start()
+        return t
+
+    def notify(self, errata):
+        """ Queue errata for notification. Never blocks."""
+        with self.lock:
+            self.idle.clear()
+            self.queue.put(errata)
+
+    def drain(self, timeout):
+        """ Wait until every queued notification is sent. Return False on timeout."""
+        return self.idle.wait(timeout)
+
+    def shutdown(self, timeout=5):
+        """ Stop dispatcher thread. Pending notifications are dropped."""
+        self.stopped.set()
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def acquire(self):
+        """ Wait until the token bucket allows another notification."""
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            self.stopped.wait((1 - self.tokens) / self.rate)
+        return False
+
+    def pending(self):
+        """ Drain erratas queued so far."""
+        erratas = []
+        while True:
+            try:
+                errata = self.queue.get_nowait()
+            except queue.Empty:
+                return erratas
+            if errata is not None:
+                erratas.append(errata)
+
+    def dispatch(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                if self.queue.empty():
+                    self.idle.set()
+            errata = self.queue.get()
+            if errata is None:
+                continue
+
+            # Let the rest of a burst arrive before deciding on a digest
+            self.stopped.wait(self.collect_delay)
+            erratas = [errata] + self.pending()
+            if len(erratas) > self.digest_threshold:
+                self.logger.info("Sending digest of %d erratas" % len(erratas))
+                if self.acquire():
+                    with self.rhen_metrics.timer('rhen_notification_seconds'):
+                        self.rhen_dbus.notify_digest(erratas)
+                    self.rhen_metrics.inc('rhen_digests_total')
+                continue
+
+            for errata in erratas:
+                if not self.acquire():
+                    break
+                with self.rhen_metrics.timer('rhen_notification_seconds'):
+                    self.rhen_dbus.notify(errata)
+                self.rhen_metrics.inc('rhen_notifications_total')
@@ -31,3 +31,30 @@ class ParseErrataFailed(Exception):
 
     def __str__(self):
         return repr(self.value)
+
+
+class ImportFailed(Exception):
+    """ Raise exception when a bulk import fails """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class FetchFailed(Exception):
+    """ Raise exception when a fetch fails after retries """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class RescoreFailed(Exception):
+    """ Raise exception when storing rescored advisories fails """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
@@ -0,0 +1,304 @@
+"""
+This file is part of Red Hat Errata Notifications (rhen.py).
+Copyright (C) 2015 Espen Hovind <espehov@ifi.uio.no>
+
+rhen.py is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rhen.py is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import asyncio
+import collections
+import configparser
+import random
+import threading
+import time
+import urllib.parse
+from concurrent import futures
+
+import requests
+import urllib3
+
+import lib.rhen_exceptions as RHENExceptions
+
+class TransientError(Exception):
+    """ Failed attempt that may succeed if retried """
+
+
+class RHENFetch(object):
+    """
+        HTTP GET for both parser engines, with connect and read timeouts, a deadline
+        for each poll cycle, retries with jittered exponential backoff and a circuit
+        breaker per host. Hedged requests send a second identical request when the
+        first is slower than the host's p95 latency, and use whichever finishes first.
+        The response is passed to a consume function inside each attempt, so reading
+        the body is covered by timeouts and retries too.
+    """
+    LATENCY_SAMPLES = 200
+
+    def __init__(self, cfg, logger, rhen_metrics, session=None, workers=1):
+        self.cfg = cfg
+        self.logger = logger
+        self.rhen_metrics = rhen_metrics
+        self.session = session
+        self.workers = workers
+        (self.connect_timeout, self.read_timeout, self.cycle_deadline, self.retries, self.backoff,
+         self.breaker_failures, self.breaker_reset, self.hedge, self.hedge_min_samples) = self.parse_config()
+        self.lock = threading.Lock()
+        self.deadline = None
+        self.breakers = dict()
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=self.LATENCY_SAMPLES))
+        self.hedges = None
+
+    def parse_config(self):
+        try:
+            return (self.cfg.getfloat('fetch', 'connect_timeout'),
+                    self.cfg.getfloat('fetch', 'read_timeout'),
+                    self.cfg.getfloat('fetch', 'cycle_deadline'),
+                    self.cfg.getint('fetch', 'retries'),
+                    self.cfg.getfloat('fetch', 'backoff'),
+                    self.cfg.getint('fetch', 'breaker_failures'),
+                    self.cfg.getfloat('fetch', 'breaker_reset'),
+                    self.cfg.getboolean('fetch', 'hedge'),
+                    self.cfg.getint('fetch', 'hedge_min_samples'))
+        except (configparser.Error, ValueError) as err:
+            self.logger.error("Failed parsing config: %s" % err)
+            raise SystemExit(1)
+
+    def shutdown(self):
+        if self.hedges:
+            self.hedges.shutdown(wait=False, cancel_futures=True)
+
+    def start_cycle(self, budget=None):
+        """
+            Start the deadline of a poll cycle, cycle_deadline or budget seconds from now.
+            Without a cycle, fetches have no deadline.
+        """
+        budget = budget or self.cycle_deadline
+        self.deadline = time.monotonic() + budget if budget else None
+
+    def expired(self):
+        """ Return True if the cycle deadline passed."""
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self, timeout):
+        """ Return read timeout capped by the cycle deadline. Raise FetchFailed if it passed."""
+        timeout = timeout or self.read_timeout
+        if self.deadline is None:
+            return timeout
+        left = self.deadline - time.monotonic()
+        if left <= 0:
+            self.rhen_metrics.inc('rhen_fetch_deadline_exceeded_total')
+            raise RHENExceptions.FetchFailed("Poll cycle deadline exceeded")
+        return min(timeout, left)
+
+    def backoff_delay(self, attempt):
+        """ Return jittered delay before retry attempt, or None if no retry is left before the deadline."""
+        if attempt >= self.retries:
+            return None
+        delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+        if self.deadline is not None and time.monotonic() + delay >= self.deadline:
+            return None
+        return delay
+
+    def check_circuit(self, host):
+        """ Raise FetchFailed while the circuit of host is open. Once reset, let one request probe it."""
+        with self.lock:
+            failures, opened = self.breakers.get(host, (0, None))
+            if opened is None:
+                return
+            if time.monotonic() - opened < self.breaker_reset:
+                raise RHENExceptions.FetchFailed("Circuit open for %s" % host)
+            self.breakers[host] = (failures, time.monotonic())
+
+    def succeeded(self, host, elapsed):
+        with self.lock:
+            self.breakers.pop(host, None)
+            self.latencies[host].append(elapsed)
+
+    def failed(self, host):
+        with self.lock:
+            failures, opened = self.breakers.get(host, (0, None))
+            failures += 1
+            if failures >= self.breaker_failures:
+                if opened is None:
+                    self.logger.error("Opening circuit for %s after %d failures" % (host, failures))
+                    self.rhen_metrics.inc('rhen_fetch_circuit_open_total', host=host)
+                opened = time.monotonic()
+            self.breakers[host] = (failures, opened)
+
+    def hedge_delay(self, host):
+        """ Return p95 latency of host, or None if hedging is off or there are too few samples."""
+        if not self.hedge:
+            return None
+        with self.lock:
+            samples = sorted(self.latencies[host])
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[int(0.95 * (len(samples) - 1))]
+
+    def get(self, url, consume, headers=None, stream=False, timeout=None, hedge=False):
+        """ GET url and return consume(response). Raise FetchFailed once retries or the deadline run out."""
+        host = urllib.parse.urlsplit(url).netloc
+        attempt = 0
+        while True:
+            self.check_circuit(host)
+            try:
+                if hedge:
+                    return self.hedged(host, url, consume, headers, stream, timeout)
+                return self.attempt(host, url, consume, headers, stream, timeout)
+            except TransientError as err:
+                self.failed(host)
+                delay = self.backoff_delay(attempt)
+                if delay is None:
+                    raise RHENExceptions.FetchFailed("%s: %s" % (url, err))
+                self.logger.debug("Retrying %s in %.1fs: %s" % (url, delay, err))
+                self.rhen_metrics.inc('rhen_fetch_retries_total', host=host)
+                time.sleep(delay)
+                attempt += 1
+
+    def attempt(self, host, url, consume, headers, stream, timeout):
+        start = time.monotonic()
+        timeout = self.remaining(timeout)
+        try:
+            # The body is always streamed, so reading it is checked against the deadline
+            with self.session.get(url, headers=headers, stream=True,
+                                  timeout=(min(self.connect_timeout, timeout), timeout)) as response:
+                if response.status_code >= 500 or response.status_code == 429:
+                    raise TransientError("HTTP %d" % response.status_code)
+                if response.status_code >= 400:
+                    raise RHENExceptions.FetchFailed("HTTP %d from %s" % (response.status_code, url))
+                self.limit_body(response, start, timeout)
+                if not stream:
+                    response.content
+                result = consume(response)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                urllib3.exceptions.HTTPError) as err:
+            raise TransientError(err)
+        self.succeeded(host, time.monotonic() - start)
+        return result
+
+    def limit_body(self, response, start, timeout):
+        """
+            Make response.iter_content, and response.content reading through it, yield bytes
+            as they arrive instead of blocking for whole chunks, and raise TransientError once
+            timeout seconds passed since start. The read timeout applies to each read only, so
+            alone it lets a server trickling bytes hold the cycle past its deadline.
+        """
+        raw = response.raw
+
+        def iter_content(chunk_size=1, decode_unicode=False):
+            def chunks():
+                if hasattr(raw, 'read1'):
+                    reads = iter(lambda: raw.read1(chunk_size, decode_content=True), b'')
+                else:
+                    # urllib3 before 2.1 has no read1, each read waits for a whole chunk
+                    reads = raw.stream(chunk_size, decode_content=True)
+                for chunk in reads:
+                    if time.monotonic() - start > timeout:
+                        raise TransientError("Body not read within %.1fs" % timeout)
+                    yield chunk
+                response._content_consumed = True
+            if decode_unicode:
+                return requests.utils.stream_decode_response_unicode(chunks(), response)
+            return chunks()
+        response.iter_content = iter_content
+
+    def hedged(self, host, url, consume, headers, stream, timeout):
+        delay = self.hedge_delay(host)
+        if delay is None:
+            return self.attempt(host, url, consume, headers, stream, timeout)
+
+        with self.lock:
+            if self.hedges is None:
+                self.hedges = futures.ThreadPoolExecutor(max_workers=2 * self.workers,
+                                                         thread_name_prefix='hedge')
+        first = self.hedges.submit(self.attempt, host, url, consume, headers, stream, timeout)
+        try:
+            return first.result(timeout=delay)
+        except futures.TimeoutError:
+            pass
+
+        # The slower request runs to completion, its result is dropped
+        self.rhen_metrics.inc('rhen_fetch_hedged_total', host=host)
+        second = self.hedges.submit(self.attempt, host, url, consume, headers, stream, timeout)
+        error = None
+        for future in futures.as_completed([first, second]):
+            try:
+                return future.result()
+            except (TransientError, RHENExceptions.FetchFailed) as err:
+                error = err
+        raise error
+
+    async def get_async(self, session, url, consume, limit, headers=None, timeout=None, hedge=False):
+        """ aiohttp variant of get. consume is a coroutine function, limit a semaphore held per attempt."""
+        host = urllib.parse.urlsplit(url).netloc
+        attempt = 0
+        while True:
+            self.check_circuit(host)
+            try:
+                if hedge:
+                    return await self.hedged_async(session, host, url, consume, limit, headers, timeout)
+                return await self.attempt_async(session, host, url, consume, limit, headers, timeout)
+            except TransientError as err:
+                self.failed(host)
+                delay = self.backoff_delay(attempt)
+                if delay is None:
+                    raise RHENExceptions.FetchFailed("%s: %s" % (url, err))
+                self.logger.debug("Retrying %s in %.1fs: %s" % (url, delay, err))
+                self.rhen_metrics.inc('rhen_fetch_retries_total', host=host)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def attempt_async(self, session, host, url, consume, limit, headers, timeout):
+        # Imported here, the thread engine never loads aiohttp
+        import aiohttp
+        async with limit:
+            start = time.monotonic()
+            timeout = self.remaining(timeout)
+            client_timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=self.connect_timeout,
+                                                   sock_read=timeout)
+            try:
+                async with session.get(url, headers=headers, timeout=client_timeout) as response:
+                    if response.status >= 500 or response.status == 429:
+                        raise TransientError("HTTP %d" % response.status)
+                    if response.status >= 400:
+                        raise RHENExceptions.FetchFailed("HTTP %d from %s" % (response.status, url))
+                    result = await consume(response)
+            except asyncio.TimeoutError:
+                raise TransientError("Timed out after %.1fs" % (time.monotonic() - start))
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as err:
+                raise TransientError(err)
+        self.succeeded(host, time.monotonic() - start)
+        return result
+
+    async def hedged_async(self, session, host, url, consume, limit, headers, timeout):
+        delay = self.hedge_delay(host)
+        first = asyncio.ensure_future(self.attempt_async(session, host, url, consume, limit, headers, timeout))
+        if delay is None:
+            return await first
+        done, pending = await asyncio.wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        self.rhen_metrics.inc('rhen_fetch_hedged_total', host=host)
+        second = asyncio.ensure_future(self.attempt_async(session, host, url, consume, limit, headers, timeout))
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+                error = task.exception()
+        raise error
@@ -0,0 +1,249 @@
+"""
+This file is part of Red Hat Errata Notifications (rhen.py).
+Copyright (C) 2015 Espen Hovind <espehov@ifi.uio.no>
+
+rhen.py is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rhen.py is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import configparser
+import json
+import os
+import queue
+import socket
+import struct
+import threading
+
+# Frames are a 4 byte big endian length followed by that many bytes of UTF-8 JSON
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME = 1 << 20
+
+def parse_address(address):
+    """ Return (family, address) of unix:<path> or tcp:<host>:<port>."""
+    kind, _, rest = address.partition(':')
+    if kind == 'unix' and rest:
+        return (socket.AF_UNIX, rest)
+    if kind == 'tcp':
+        host, _, port = rest.rpartition(':')
+        return (socket.AF_INET, (host or '127.0.0.1', int(port)))
+    raise ValueError("hub address must be unix:<path> or tcp:<host>:<port>, not %s" % address)
+
+def send_frame(sock, message):
+    data = json.dumps(message, default=str).encode('utf-8')
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+def recv_frame(sock):
+    size, = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+    if size > MAX_FRAME:
+        raise ConnectionError("Frame of %d bytes exceeds limit" % size)
+    return json.loads(recv_exactly(sock, size).decode('utf-8'))
+
+
+class RHENHub(object):
+    """
+        Publish new erratas to subscribers, in place of the dispatcher. Each errata is
+        appended to the hub_log table, whose seq is the sequence number subscribers track.
+        A subscriber sends {"type": "subscribe", "after": <seq>} and is sent every
+        logged errata after seq, then new ones as {"type": "errata", "seq": .., "errata": ..}.
+    """
+    def __init__(self, cfg, logger, rhen_db, rhen_metrics):
+        self.cfg = cfg
+        self.logger = logger
+        self.rhen_db = rhen_db
+        self.rhen_metrics = rhen_metrics
+        self.address, self.retention = self.parse_config()
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.rhen_metrics.callback('rhen_hub_subscribers', lambda: len(self.subscribers))
+        self.server = self.init_server()
+        self.thread = self.init_thread()
+
+    def parse_config(self):
+        try:
+            address = parse_address(self.cfg.get('hub', 'address'))
+            retention = self.cfg.getint('hub', 'retention')
+            return (address, retention)
+        except (configparser.Error, ValueError) as err:
+            self.logger.error("Failed parsing config: %s" % err)
+            raise SystemExit(1)
+
+    def init_server(self):
+        family, address = self.address
+        try:
+            server = socket.socket(family, socket.SOCK_STREAM)
+            if family == socket.AF_UNIX:
+                if os.path.exists(address):
+                    os.remove(address)
+            else:
+                server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(address)
+            server.listen()
+        except OSError as err:
+            self.logger.error("Failed listening on %s: %s" % (address, err))
+            raise SystemExit(1)
+        self.logger.info("Hub listening on %s" % (address,))
+        return server
+
+    def init_thread(self):
+        t = threading.Thread(target=self.accept, name='hub')
+        t.daemon = True
+        t.start()
+        return t
+
+    def accept(self):
+        while True:
+            try:
+                sock, peer = self.server.accept()
+            except OSError:
+                # Server socket closed by shutdown
+                return
+            t = threading.Thread(target=self.serve, args=(sock,), name='hub-subscriber')
+            t.daemon = True
+            t.start()
+
+    def notify(self, errata):
+        """ Log errata with the next sequence number and queue it for every subscriber."""
+        seq = self.rhen_db.add_hub_log(errata['advisory'], json.dumps(errata, default=str), self.retention)
+        if seq is None:
+            return
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.put((seq, errata))
+        self.rhen_metrics.inc('rhen_hub_published_total')
+
+    def serve(self, sock):
+        """ Replay what the subscriber missed, then forward new erratas until it disconnects."""
+        live = queue.Queue()
+        try:
+            request = recv_frame(sock)
+            if request.get('type') != 'subscribe':
+                raise ConnectionError("Expected subscribe, got %s" % request.get('type'))
+            sent = int(request.get('after', 0))
+
+            # Subscribe before replaying, so nothing published meanwhile is missed
+            with self.lock:
+                self.subscribers.add(live)
+            self.logger.info("Subscriber replaying after seq %d" % sent)
+            for seq, errata in self.rhen_db.find_hub_log(sent):
+                send_frame(sock, {'type': 'errata', 'seq': seq, 'errata': json.loads(errata)})
+                sent = seq
+            # Forwarding needs no db, subscribers may stay connected for days
+            self.rhen_db.release()
+            while True:
+                item = live.get()
+                if item is None:
+                    break
+                seq, errata = item
+                if seq > sent:
+                    send_frame(sock, {'type': 'errata', 'seq': seq, 'errata': errata})
+                    sent = seq
+        except (OSError, ValueError) as err:
+            self.logger.info("Subscriber disconnected: %s" % err)
+        finally:
+            with self.lock:
+                self.subscribers.discard(live)
+            sock.close()
+            self.rhen_db.release()
+
+    def shutdown(self, timeout=5):
+        """ Stop accepting subscribers and disconnect the ones connected."""
+        try:
+            # Wakes up the accept thread, close alone leaves it listening
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+        self.thread.join(timeout)
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.put(None)
+        family, address = self.address
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+
+
+class RHENHubClient(object):
+    """
+        Thin client of a hub. Erratas received are passed to the dispatcher for
+        notification. The last seq is kept in the state file, so only erratas missed
+        while disconnected are replayed. Reconnects with backoff until stopped.
+    """
+    MAX_RECONNECT = 60
+
+    def __init__(self, cfg, logger, rhen_dispatcher):
+        self.cfg = cfg
+        self.logger = logger
+        self.rhen_dispatcher = rhen_dispatcher
+        self.address, self.state = self.parse_config()
+        self.seq = self.load_seq()
+        self.stopped = threading.Event()
+
+    def parse_config(self):
+        try:
+            address = parse_address(self.cfg.get('hub', 'address'))
+            state = self.cfg.get('hub', 'state')
+            return (address, state)
+        except (configparser.Error, ValueError) as err:
+            self.logger.error("Failed parsing config: %s" % err)
+            raise SystemExit(1)
+
+    def load_seq(self):
+        try:
+            with open(self.state) as fd:
+                return int(fd.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def save_seq(self, seq):
+        try:
+            tmp = self.state + '.tmp'
+            with open(tmp, 'w') as fd:
+                fd.write(str(seq))
+            os.replace(tmp, self.state)
+        except IOError as err:
+            self.logger.error("Failed saving hub state: %s" % err)
+
+    def run(self):
+        delay = 1
+        while not self.stopped.is_set():
+            family, address = self.address
+            try:
+                with socket.socket(family, socket.SOCK_STREAM) as sock:
+                    sock.connect(address)
+                    self.logger.info("Subscribed to hub %s after seq %d" % (address, self.seq))
+                    send_frame(sock, {'type': 'subscribe', 'after': self.seq})
+                    delay = 1
+                    while not self.stopped.is_set():
+                        self.receive(recv_frame(sock))
+            except (OSError, ValueError) as err:
+                self.logger.error("Hub connection failed: %s" % err)
+            self.stopped.wait(delay)
+            delay = min(delay * 2, self.MAX_RECONNECT)
+
+    def receive(self, message):
+        if message.get('type') != 'errata':
+            return
+        self.rhen_dispatcher.notify(message['errata'])
+        self.seq = message['seq']
+        self.save_seq(self.seq)
+
+    def shutdown(self):
+        self.stopped.set()
@@ -0,0 +1,146 @@
+"""
+This file is part of Red Hat Errata Notifications (rhen.py).
+Copyright (C) 2015 Espen Hovind <espehov@ifi.uio.no>
+
+rhen.py is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rhen.py is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import csv
+import gzip
+import json
+import re
+
+import lib.rhen_exceptions as RHENExceptions
+
+class RHENCveImport(object):
+    """
+        Bulk import of CVE scores into the cve_scores table, for scoring without
+        scraping CVE pages. Reads NVD JSON feeds (1.1 or 2.0 API format) or CSV
+        files with cve, cvss2, cvss3 columns, optionally gzipped. Files are streamed,
+        memory is bounded by one CVE entry and one batch of rows.
+    """
+    BATCH_SIZE = 1000
+    CHUNK_SIZE = 65536
+    NVD_ITEMS = re.compile(r'"(CVE_Items|vulnerabilities)"\s*:\s*\[')
+    CVE = re.compile(r'^CVE-\d{4}-\d{4,}$')
+
+    def __init__(self, cfg, logger, rhen_db):
+        self.cfg = cfg
+        self.logger = logger
+        self.rhen_db = rhen_db
+
+    def import_file(self, path):
+        """ Import all scores in path. Return number of CVEs stored."""
+        self.logger.info("Importing CVE scores from %s" % path)
+        name = path[:-3] if path.endswith('.gz') else path
+        opener = gzip.open if path.endswith('.gz') else open
+        try:
+            with opener(path, 'rt', encoding='utf-8', newline='') as fd:
+                if name.endswith('.csv'):
+                    rows = self.read_csv(fd)
+                elif name.endswith('.json'):
+                    rows = self.read_nvd_json(fd)
+                else:
+                    raise RHENExceptions.ImportFailed("Unknown format, expected .csv or .json: %s" % path)
+                return self.store(rows)
+        except (IOError, ValueError) as err:
+            self.logger.error("Failed importing %s: %s" % (path, err))
+            raise RHENExceptions.ImportFailed(err)
+
+    def store(self, rows):
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.BATCH_SIZE:
+                count += self.rhen_db.add_imported_cve_scores(batch)
+                batch = []
+        if batch:
+            count += self.rhen_db.add_imported_cve_scores(batch)
+        self.logger.info("Imported %d CVE scores" % count)
+        return count
+
+    def read_csv(self, fd):
+        """ Yield (cve, cvss2, cvss3) from rows of cve, cvss2, cvss3. A header row is skipped."""
+        for row in csv.reader(fd):
+            if not row or not self.CVE.match(row[0].strip()):
+                continue
+            scores = [self.parse_score(score) for score in row[1:3]]
+            scores += [None] * (2 - len(scores))
+            yield (row[0].strip(), scores[0], scores[1])
+
+    def parse_score(self, score):
+        score = score.strip()
+        return float(score) if score else None
+
+    def read_nvd_json(self, fd):
+        """ Yield (cve, cvss2, cvss3) of each CVE entry, decoding one entry at a time."""
+        for item in self.iter_json_items(fd):
+            if 'CVE_data_meta' in item.get('cve', {}):
+                yield self.parse_nvd_11(item)
+            else:
+                yield self.parse_nvd_20(item)
+
+    def iter_json_items(self, fd):
+        """ Yield the objects of the CVE_Items or vulnerabilities array of an NVD document."""
+        decoder = json.JSONDecoder()
+        buf = ''
+        match = None
+        while match is None:
+            chunk = fd.read(self.CHUNK_SIZE)
+            if not chunk:
+                raise ValueError("No CVE_Items or vulnerabilities array found")
+            # Keep the tail, the key may be split across chunks
+            buf = buf[-64:] + chunk
+            match = self.NVD_ITEMS.search(buf)
+        buf = buf[match.end():]
+        pos = 0
+        eof = False
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            try:
+                if pos == len(buf):
+                    raise ValueError("Need more data")
+                item, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise ValueError("Truncated NVD document")
+                chunk = fd.read(self.CHUNK_SIZE)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+
+    def parse_nvd_11(self, item):
+        impact = item.get('impact', {})
+        cvss2 = impact.get('baseMetricV2', {}).get('cvssV2', {}).get('baseScore')
+        cvss3 = impact.get('baseMetricV3', {}).get('cvssV3', {}).get('baseScore')
+        return (item['cve']['CVE_data_meta']['ID'], cvss2, cvss3)
+
+    def parse_nvd_20(self, item):
+        cve = item['cve']
+        metrics = cve.get('metrics', {})
+        cvss2 = cvss3 = None
+        for metric in metrics.get('cvssMetricV2', []):
+            cvss2 = metric['cvssData']['baseScore']
+            if metric.get('type') == 'Primary':
+                break
+        for metric in metrics.get('cvssMetricV31', []) + metrics.get('cvssMetricV30', []):
+            cvss3 = metric['cvssData']['baseScore']
+            if metric.get('type') == 'Primary':
+                break
+        return (cve['id'], cvss2, cvss3)
@@ -0,0 +1,170 @@
+"""
+This file is part of Red Hat Errata Notifications (rhen.py).
+Copyright (C) 2015 Espen Hovind <espehov@ifi.uio.no>
+
+rhen.py is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rhen.py is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import collections
+import configparser
+import hashlib
+import math
+import sys
+import threading
+
+class RHENBloomFilter(object):
+    """ Bloom filter of strings, sized for capacity items at false_positive_rate."""
+    def __init__(self, capacity, false_positive_rate):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        # Double hashing, k positions from two 64 bit halves of one digest
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+    def expected_false_positive_rate(self):
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class RHENIndex(object):
+    """
+        In-memory index of advisories in the erratas table. An LRU set of recently seen
+        advisories answers "known" without a query, and a Bloom filter of every advisory
+        answers "new" without a query. Only advisories the filter may contain are looked
+        up in the db. Rows stored after the index was loaded, also by other processes
+        (--backfill, other daemons), are added by rowid before lookups. The filter is
+        rebuilt twice as large when it outgrows its capacity.
+    """
+    def __init__(self, cfg, logger):
+        self.cfg = cfg
+        self.logger = logger
+        self.lru_size, self.false_positive_rate = self.parse_config()
+        self.lock = threading.Lock()
+        self.recent = collections.OrderedDict()
+        self.bloom = None
+        self.rowid = 0
+        self.reset_stats()
+
+    def parse_config(self):
+        try:
+            lru_size = self.cfg.getint('index', 'lru_size')
+            false_positive_rate = self.cfg.getfloat('index', 'false_positive_rate')
+            if not 0 < false_positive_rate < 1:
+                raise ValueError("false_positive_rate must be between 0 and 1")
+            return (lru_size, false_positive_rate)
+        except (configparser.Error, ValueError) as err:
+            self.logger.error("Failed parsing config: %s" % err)
+            raise SystemExit(1)
+
+    def reset_stats(self):
+        self.known = 0
+        self.new = 0
+        self.false_positives = 0
+        self.external = 0
+        self.queried = 0
+
+    def load(self, count, advisories, rowid):
+        """
+            Build the index from count advisories, oldest first, sized for twice as many.
+            rowid is the last row of the erratas table they include. The index in use is
+            only replaced once every advisory is read.
+        """
+        bloom = RHENBloomFilter(max(1024, 2 * count), self.false_positive_rate)
+        recent = collections.OrderedDict()
+        for advisory in advisories:
+            bloom.add(advisory)
+            recent[advisory] = True
+            if len(recent) > self.lru_size:
+                recent.popitem(last=False)
+        with self.lock:
+            self.bloom, self.recent, self.rowid = bloom, recent, rowid
+        self.logger.debug("Loaded index of %d advisories: %s" % (count, self.memory()))
+
+    def full(self):
+        return self.bloom.count > self.bloom.capacity
+
+    def touch(self, advisory):
+        self.recent[advisory] = True
+        self.recent.move_to_end(advisory)
+        if len(self.recent) > self.lru_size:
+            self.recent.popitem(last=False)
+
+    def lookup(self, advisory):
+        """ Return True if advisory is known, False if it is new, None if the db must be asked."""
+        with self.lock:
+            if advisory in self.recent:
+                self.recent.move_to_end(advisory)
+                self.known += 1
+                return True
+            if advisory not in self.bloom:
+                self.new += 1
+                return False
+            self.queried += 1
+            return None
+
+    def found(self, advisory, found):
+        """ Record the db answer to a lookup of advisory."""
+        with self.lock:
+            if found:
+                self.touch(advisory)
+                self.known += 1
+            else:
+                self.false_positives += 1
+                self.new += 1
+
+    def sync(self, rows):
+        """ Add (rowid, advisory) rows stored since the index was loaded, in rowid order."""
+        with self.lock:
+            for rowid, advisory in rows:
+                if advisory not in self.bloom:
+                    # Not added by this process
+                    self.external += 1
+                    self.bloom.add(advisory)
+                self.touch(advisory)
+                self.rowid = rowid
+
+    def add(self, advisories):
+        with self.lock:
+            for advisory in advisories:
+                if advisory not in self.bloom:
+                    self.bloom.add(advisory)
+                self.touch(advisory)
+
+    def memory(self):
+        lru = sys.getsizeof(self.recent) + sum(sys.getsizeof(advisory) for advisory in self.recent)
+        return "Bloom filter %d KiB (%d hashes, capacity %d), LRU %d KiB (%d of %d advisories)" % (
+            len(self.bloom.bits) // 1024, self.bloom.hashes, self.bloom.capacity,
+            lru // 1024, len(self.recent), self.lru_size)
+
+    def log_stats(self):
+        """ Log hit rates, false positive rate and memory use since last call, then reset counters."""
+        absent = self.new
+        rate = self.false_positives / absent if absent else 0.0
+        self.logger.debug("Advisory index: %d known, %d new, %d db lookups, %d stored by other processes, "
+                          "false positive rate %.4f (expected %.4f). %s" % (self.known, self.new, self.queried,
+                          self.external, rate, self.bloom.expected_false_positive_rate(), self.memory()))
+        self.reset_stats()
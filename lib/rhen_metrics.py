@@ -0,0 +1,197 @@
+"""
+This file is part of Red Hat Errata Notifications (rhen.py).
+Copyright (C) 2015 Espen Hovind <espehov@ifi.uio.no>
+
+rhen.py is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rhen.py is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import bisect
+import collections
+import contextlib
+import http.server
+import os
+import threading
+import time
+
+# name: (type, help)
+DEFINITIONS = collections.OrderedDict([
+    ('rhen_poll_cycles_total', ('counter', "Poll cycles run.")),
+    ('rhen_poll_failures_total', ('counter', "Poll cycles that failed.")),
+    ('rhen_poll_cycle_seconds', ('histogram', "Duration of a poll cycle.")),
+    ('rhen_poll_cycle_last_seconds', ('gauge', "Duration of the last poll cycle.")),
+    ('rhen_check_interval_seconds', ('gauge', "Configured interval between poll cycles.")),
+    ('rhen_feed_fetch_seconds', ('histogram', "Time to fetch the RSS feed.")),
+    ('rhen_feed_failures_total', ('counter', "Feed fetches that failed.")),
+    ('rhen_feed_unchanged_total', ('counter', "Feed fetches skipped as not modified or identical.")),
+    ('rhen_feed_parse_seconds', ('histogram', "Time to parse the RSS feed.")),
+    ('rhen_dedup_seconds', ('histogram', "Time to find new advisories in the feed.")),
+    ('rhen_erratas_new_total', ('counter', "New erratas found.")),
+    ('rhen_cve_request_seconds', ('histogram', "Time to fetch and parse one CVE page.")),
+    ('rhen_cve_requests_total', ('counter', "CVE pages fetched.")),
+    ('rhen_cve_bytes_total', ('counter', "Bytes of CVE pages transferred.")),
+    ('rhen_cve_failures_total', ('counter', "CVE pages that gave no score.")),
+    ('rhen_cve_advisory_seconds', ('histogram', "Time until every CVE of an advisory is resolved.")),
+    ('rhen_cve_imported_hits_total', ('counter', "CVE scores found in imported data.")),
+    ('rhen_cve_cache_hits_total', ('counter', "CVE scores found in cache.")),
+    ('rhen_cve_cache_misses_total', ('counter', "CVE scores missing from cache.")),
+    ('rhen_fetch_retries_total', ('counter', "Fetches retried after a transient failure.")),
+    ('rhen_fetch_hedged_total', ('counter', "Second requests sent for fetches slower than p95.")),
+    ('rhen_fetch_circuit_open_total', ('counter', "Times a host's circuit breaker opened.")),
+    ('rhen_fetch_deadline_exceeded_total', ('counter', "Fetches refused as the poll cycle deadline passed.")),
+    ('rhen_rescore_queue_depth', ('gauge', "Advisories waiting for a CVSS2 score to be retried.")),
+    ('rhen_rescore_attempts_total', ('counter', "Advisories retried by the rescore queue.")),
+    ('rhen_rescored_total', ('counter', "Advisories fully scored by the rescore queue.")),
+    ('rhen_db_write_seconds', ('histogram', "Time to store new erratas.")),
+    ('rhen_notification_seconds', ('histogram', "Time to send one notification.")),
+    ('rhen_notifications_total', ('counter', "Notifications sent.")),
+    ('rhen_digests_total', ('counter', "Digest notifications sent.")),
+    ('rhen_notification_queue_depth', ('gauge', "Erratas waiting for notification.")),
+    ('rhen_hub_subscribers', ('gauge', "Subscribers connected to the hub.")),
+    ('rhen_hub_published_total', ('counter', "Erratas published by the hub.")),
+    ('rhen_threads', ('gauge', "Live threads in the daemon.")),
+])
+
+class RHENMetrics(object):
+    """
+        Counters, gauges and histograms in Prometheus text format.
+        Exported as a textfile after each poll, and optionally on a localhost HTTP endpoint.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self, cfg, logger):
+        self.cfg = cfg
+        self.logger = logger
+        self.textfile, self.port = self.parse_config()
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.gauges = dict()
+        self.callbacks = dict()
+        self.histograms = dict()
+        self.server = None
+        self.callback('rhen_threads', threading.active_count)
+
+    def parse_config(self):
+        try:
+            textfile = self.cfg.get('metrics', 'textfile', fallback='')
+            port = self.cfg.getint('metrics', 'port', fallback=0)
+            return (textfile, port)
+        except ValueError as err:
+            self.logger.error("Failed parsing config: %s" % err)
+            raise SystemExit(1)
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def callback(self, name, func):
+        """ Gauge read from func whenever metrics are rendered."""
+        self.callbacks[(name, ())] = func
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+            i = bisect.bisect_left(self.BUCKETS, value)
+            if i < len(self.BUCKETS):
+                histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def render(self):
+        """ Return all metrics in Prometheus text exposition format."""
+        with self.lock:
+            samples = collections.defaultdict(list)
+            for (name, labels), value in self.counters.items():
+                samples[name].append((name, labels, value))
+            for (name, labels), value in self.gauges.items():
+                samples[name].append((name, labels, value))
+            for (name, labels), func in self.callbacks.items():
+                samples[name].append((name, labels, func()))
+            for (name, labels), (buckets, total, count) in self.histograms.items():
+                cumulative = 0
+                for bound, bucket in zip(self.BUCKETS, buckets):
+                    cumulative += bucket
+                    samples[name].append((name + '_bucket', labels + (('le', repr(float(bound))),), cumulative))
+                samples[name].append((name + '_bucket', labels + (('le', '+Inf'),), count))
+                samples[name].append((name + '_sum', labels, total))
+                samples[name].append((name + '_count', labels, count))
+
+        lines = []
+        for name in sorted(samples, key=lambda name: (name not in DEFINITIONS, name)):
+            kind, description = DEFINITIONS.get(name, ('untyped', ''))
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for sample, labels, value in samples[name]:
+                label = ','.join('%s="%s"' % (key, value) for key, value in labels)
+                lines.append("%s%s %s" % (sample, '{%s}' % label if label else '', repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self):
+        """ Atomically replace the metrics textfile, for node_exporter style collectors."""
+        if not self.textfile:
+            return
+        try:
+            tmp = self.textfile + '.tmp'
+            with open(tmp, 'w') as fd:
+                fd.write(self.render())
+            os.replace(tmp, self.textfile)
+        except IOError as err:
+            self.logger.error("Failed writing metrics: %s" % err)
+
+    def start(self):
+        """ Serve metrics on http://127.0.0.1:port/metrics if port is configured."""
+        if not self.port:
+            return
+        metrics = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        try:
+            self.server = http.server.ThreadingHTTPServer(('127.0.0.1', self.port), MetricsHandler)
+        except OSError as err:
+            self.logger.error("Failed starting metrics endpoint: %s" % err)
+            return
+        t = threading.Thread(target=self.server.serve_forever, name='metrics')
+        t.daemon = True
+        t.start()
+        self.logger.info("Serving metrics on http://127.0.0.1:%d/metrics" % self.port)
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
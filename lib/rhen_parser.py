@@ -15,62 +15,318 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
 """
-import urllib
+import hashlib
+import io
 import re
 import requests
 import collections
+import copy
+from concurrent import futures
 from lxml import etree
-import queue
-import threading
 import time
 import configparser
 
 import lib.rhen_exceptions as RHENExceptions
+from lib.rhen_cache import RHENCveCache
+from lib.rhen_fetch import RHENFetch
 
 class RHENParser(object):
+    # Most poll cycles a failing feed sits out, doubling with each failure
+    MAX_FEED_SKIP = 16
+    CVE_CHUNK_SIZE = 8192
+    # Most bytes read after the CVSS2 score to keep the connection, larger remainders close it
+    CVE_DRAIN_LIMIT = 65536
 
-    def __init__(self, cfg, logger, rhen_db, rhen_dbus):
+    def __init__(self, cfg, logger, rhen_db, rhen_dbus, rhen_metrics):
         self.cfg = cfg
         self.logger = logger
         self.rhen_db = rhen_db
         self.rhen_dbus = rhen_dbus
-        self.cve_base, self.errata_rss = self.parse_config()
+        self.rhen_metrics = rhen_metrics
+        self.cve_base, self.errata_feeds, self.feed_timeout = self.parse_config()
+        self.stream_rss, self.stop_after_seen, self.stream_cve = self.parse_config_stream()
         self.parser = self.init_parser()
+        self.cve_cache = self.init_cve_cache()
+        self.feed_state = dict()
+        self.feed_failures = dict()
+        self.session = self.init_session()
+        self.executor = self.init_executor()
+        self.fetch = self.init_fetch()
 
     def parse_config(self):
         try:
             cve_base = self.cfg.get('main', 'cve_details')
-            errata_rss = self.cfg.get('main', 'errata_rss')
-            return (cve_base, errata_rss)
-        except configparser.Error as err:
+            errata_feeds = self.cfg.get('main', 'errata_rss').split()
+            feed_timeout = self.cfg.getint('main', 'feed_timeout', fallback=60)
+            return (cve_base, errata_feeds, feed_timeout)
+        except (configparser.Error, ValueError) as err:
+            self.logger.error("Failed parsing config: %s" % err)
+            raise SystemExit(1)
+
+    def parse_config_stream(self):
+        try:
+            stream_rss = self.cfg.getboolean('processor', 'stream_rss', fallback=False)
+            stop_after_seen = self.cfg.getint('processor', 'stop_after_seen', fallback=10)
+            cve_extractor = self.cfg.get('processor', 'cve_extractor', fallback='tree')
+            if cve_extractor not in ('stream', 'tree'):
+                raise ValueError("cve_extractor must be stream or tree, not %s" % cve_extractor)
+            return (stream_rss, stop_after_seen, cve_extractor == 'stream')
+        except ValueError as err:
             self.logger.error("Failed parsing config: %s" % err)
             raise SystemExit(1)
 
     def init_parser(self):
         return etree.XMLParser(ns_clean=True, recover=True)
 
+    def init_cve_cache(self):
+        return RHENCveCache(self.cfg, self.logger, self.rhen_db)
+
+    def init_session(self):
+        """ Keep-alive session, with pooled connections for each worker and its hedged requests."""
+        workers = self.cfg.getint('processor', 'workers')
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2 * workers)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def init_fetch(self):
+        return RHENFetch(self.cfg, self.logger, self.rhen_metrics, self.session,
+                         self.cfg.getint('processor', 'workers'))
+
+    def init_executor(self):
+        return futures.ThreadPoolExecutor(max_workers=self.cfg.getint('processor', 'workers'),
+                                          thread_name_prefix='cvss2')
+
+    def shutdown(self):
+        """ Stop CVE workers and close pooled connections."""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.fetch.shutdown()
+        self.session.close()
+
     def parse_errata(self):
-        """ Load RSS and compare with previous erratas."""
-        doc = self.load_rss_fead()
-
-        for errata_item in doc.iterfind('channel/item'):
-            title = errata_item.findtext('title')
-            advisory = self.parse_errata_advisory(title)
-            # Skip already seen erratas
-            if self.rhen_db.find_errata(advisory) is not None:
-                continue
+        """
+            Load RSS feeds and compare with previous erratas. Skip feeds that are unchanged.
+            Return True if any feed changed since last check.
+        """
+        self.fetch.start_cycle()
+        feeds = self.load_rss_feeds()
+        if not feeds:
+            return False
 
-            errata = self.parse_errata_content(advisory, errata_item)
-            self.rhen_db.add_errata(errata)
+        with self.rhen_metrics.timer('rhen_dedup_seconds'):
+            erratas = self.merge_new_erratas(feeds)
+        self.rhen_metrics.inc('rhen_erratas_new_total', len(erratas))
+        self.score_erratas(erratas)
+        if erratas:
+            with self.rhen_metrics.timer('rhen_db_write_seconds'):
+                self.rhen_db.add_erratas(erratas)
+        for errata in erratas:
             self.rhen_dbus.notify(errata)
 
-    def load_rss_fead(self):
+        self.finish_cycle(feeds)
+        return True
+
+    def merge_new_erratas(self, feeds):
+        """ Return new erratas from all feeds. An advisory found on several feeds is kept once."""
+        erratas = collections.OrderedDict()
+        for url, items in feeds.items():
+            for errata in self.find_new_erratas(items):
+                erratas.setdefault(errata['advisory'], errata)
+        return list(erratas.values())
+
+    def find_new_erratas(self, items):
+        """ Return parsed content of feed items not already in db."""
+        if self.stream_rss:
+            return self.find_new_erratas_streaming(items)
+
+        errata_items = collections.OrderedDict()
+        for errata_item in items:
+            advisory = self.parse_errata_advisory(errata_item.findtext('title'))
+            errata_items.setdefault(advisory, errata_item)
+
+        # Skip already seen erratas
+        new = self.rhen_db.find_new_erratas(list(errata_items))
+        return [self.parse_errata_content(advisory, errata_item)
+                for advisory, errata_item in errata_items.items() if advisory in new]
+
+    def find_new_erratas_streaming(self, items):
+        """
+            Read items as they are parsed, looking them up in db stop_after_seen at a time.
+            The feed is newest first, so stop reading after stop_after_seen advisories in
+            a row are already in db.
+        """
+        erratas = collections.OrderedDict()
+        seen = 0
+        for batch in self.errata_batches(items, self.stop_after_seen):
+            new = self.rhen_db.find_new_erratas(list(batch))
+            for advisory, errata_item in batch.items():
+                if advisory not in new:
+                    seen += 1
+                    if seen >= self.stop_after_seen:
+                        self.logger.debug("Stopped reading RSS feed at %s" % advisory)
+                        return list(erratas.values())
+                    continue
+                seen = 0
+                if advisory not in erratas:
+                    erratas[advisory] = self.parse_errata_content(advisory, errata_item)
+        return list(erratas.values())
+
+    def errata_batches(self, items, size):
+        """
+            Yield dicts of advisory -> item of size advisories each, in feed order. Items
+            are copied, the streaming parser frees them once read.
+        """
+        batch = collections.OrderedDict()
+        for errata_item in items:
+            advisory = self.parse_errata_advisory(errata_item.findtext('title'))
+            if advisory not in batch:
+                batch[advisory] = copy.deepcopy(errata_item)
+            if len(batch) >= size:
+                yield batch
+                batch = collections.OrderedDict()
+        if batch:
+            yield batch
+
+    def finish_cycle(self, feeds):
+        # Only remember validators once every item is stored
+        for url in feeds:
+            self.rhen_db.update_feed_state(url, *self.feed_state[url])
+        self.cve_cache.evict()
+        self.rhen_metrics.inc('rhen_cve_cache_hits_total', self.cve_cache.hits)
+        self.rhen_metrics.inc('rhen_cve_cache_misses_total', self.cve_cache.misses)
+        self.cve_cache.log_stats()
+        self.rhen_db.index.log_stats()
+
+    def due_feeds(self):
+        """
+            Return feeds to check this cycle. Failing feeds sit out a number of cycles while
+            other feeds are checked. If every feed would sit out, all are checked, the schedule
+            already backs off from failed checks.
+        """
+        due = []
+        for url in self.errata_feeds:
+            failures, skip = self.feed_failures.get(url, (0, 0))
+            if skip:
+                self.logger.debug("Skipping failing feed %s" % url)
+                self.feed_failures[url] = (failures, skip - 1)
+                continue
+            due.append(url)
+        if not due:
+            return list(self.errata_feeds)
+        return due
+
+    def feed_failed(self, url):
+        failures = self.feed_failures.get(url, (0, 0))[0] + 1
+        self.feed_failures[url] = (failures, min(2 ** failures - 1, self.MAX_FEED_SKIP))
+        self.rhen_metrics.inc('rhen_feed_failures_total', feed=url)
+
+    def load_rss_feeds(self):
+        """ Fetch all due feeds concurrently. Return dict of url -> items of changed feeds."""
+        pending = [(url, self.executor.submit(self.fetch_rss_fead, url, self.rss_validators(url)))
+                   for url in self.due_feeds()]
+        responses = []
+        for url, future in pending:
+            try:
+                responses.append((url, future.result()))
+            except RHENExceptions.ParseErrataFailed as err:
+                responses.append((url, err))
+        return self.parse_rss_feeds(responses)
+
+    def fetch_rss_fead(self, url, headers):
+        """
+            Conditional GET of RSS feed using validators from last check.
+            Return (headers, body), or None if the server replies 304.
+        """
+        try:
+            self.logger.info("Loading RSS feed %s" % url)
+            with self.rhen_metrics.timer('rhen_feed_fetch_seconds', feed=url):
+                return self.fetch.get(url, self.read_rss_fead, headers=headers, timeout=self.feed_timeout)
+        except RHENExceptions.FetchFailed as err:
+            self.logger.error("Failed loading rss feed %s: %s" % (url, err))
+            raise RHENExceptions.ParseErrataFailed(err)
+
+    def read_rss_fead(self, response):
+        if response.status_code == 304:
+            self.logger.info("RSS feed not modified: %s" % response.url)
+            self.rhen_metrics.inc('rhen_feed_unchanged_total')
+            return None
+        self.logger.debug(response.headers)
+        return (response.headers, response.content)
+
+    def parse_rss_feeds(self, responses):
+        """
+            Parse (url, response) pairs, where response is (headers, body), None if not
+            modified, or the exception that failed the fetch. Return dict of url -> items.
+            Raise ParseErrataFailed only if every feed failed.
+        """
+        feeds = collections.OrderedDict()
+        failed = 0
+        for url, response in responses:
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                items = self.parse_rss_fead(url, *response) if response else None
+            except RHENExceptions.ParseErrataFailed:
+                failed += 1
+                self.feed_failed(url)
+                continue
+            self.feed_failures.pop(url, None)
+            if items is not None:
+                feeds[url] = items
+
+        if failed == len(responses):
+            raise RHENExceptions.ParseErrataFailed("Failed loading every feed")
+        return feeds
+
+    def rss_validators(self, url):
+        """ Return request headers for a conditional GET of the RSS feed."""
+        etag, last_modified, digest = self.rhen_db.find_feed_state(url)
+        headers = dict()
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def parse_rss_fead(self, url, headers, body):
+        """
+            Parse RSS feed body and return an iterator over its items.
+            Return None if identical to body from last check.
+        """
+        digest = self.rhen_db.find_feed_state(url)[2]
+        self.feed_state[url] = (headers.get('ETag'), headers.get('Last-Modified'),
+                                hashlib.sha256(body).hexdigest())
+        if self.feed_state[url][2] == digest:
+            self.logger.info("RSS feed unchanged: %s" % url)
+            self.rhen_metrics.inc('rhen_feed_unchanged_total')
+            self.rhen_db.update_feed_state(url, *self.feed_state[url])
+            return None
+
+        # Streamed items are parsed while finding new erratas, timed as dedup
+        if self.stream_rss:
+            return self.iterparse_rss_fead(body)
+
         try:
-            self.logger.info("Loading RSS feed")
-            erratas = urllib.request.urlopen(self.errata_rss)
-            self.logger.debug(erratas.info()._headers)
-            return etree.parse(erratas, self.parser)
-        except (IOError, etree.XMLSyntaxError) as err:
+            with self.rhen_metrics.timer('rhen_feed_parse_seconds'):
+                doc = etree.fromstring(body, self.parser)
+        except etree.XMLSyntaxError as err:
+            self.logger.error("Failed parsing rss feed %s: %s" % (url, err))
+            raise RHENExceptions.ParseErrataFailed(err)
+        if doc is None:
+            self.logger.error("Empty rss feed %s" % url)
+            raise RHENExceptions.ParseErrataFailed("Empty RSS feed")
+        return doc.iterfind('channel/item')
+
+    def iterparse_rss_fead(self, body):
+        """ Yield each item as soon as it is parsed, and free it once processed."""
+        try:
+            for event, errata_item in etree.iterparse(io.BytesIO(body), tag='item', recover=True):
+                yield errata_item
+                errata_item.clear()
+                while errata_item.getprevious() is not None:
+                    del errata_item.getparent()[0]
+        except etree.XMLSyntaxError as err:
             self.logger.error("Failed parsing rss feed: %s" % err)
             raise RHENExceptions.ParseErrataFailed(err)
 
@@ -88,7 +344,7 @@ class RHENParser(object):
 
     def parse_errata_cve(self, description):
         """ Return list of CVEs in advisory. Empty list if none found."""
-        return re.findall(r'CVE-\d{4}-\d{4}', description, re.MULTILINE)
+        return re.findall(r'CVE-\d{4}-\d{4,}', description, re.MULTILINE)
 
     def parse_errata_content(self, advisory, errata_item):
         errata = dict()
@@ -98,59 +354,138 @@ class RHENParser(object):
         errata['link'] = errata_item.findtext('link')
 
         if 'RHSA' in advisory:
-            cve = self.parse_errata_cve(errata_item.findtext('description'))
-            if len(cve) == 0:
+            errata['cve'] = self.parse_errata_cve(errata_item.findtext('description'))
+            if len(errata['cve']) == 0:
                 self.logger.error("Could not find CVEs for security advisory %s" % advisory)
-                return errata
-            errata['cvss2'] = self.get_cvss2_score(cve)
         return errata
 
-    def get_cvss2_score(self, CVE):
+    def score_erratas(self, erratas):
+        """ Resolve the CVEs of all erratas in one pass, then set each errata's max CVSS2 score."""
         start = time.time()
-        cvss2_scores = collections.deque()
-        q = queue.Queue()
+        CVE = set(cve for errata in erratas for cve in errata.get('cve', []))
+        scores = self.get_cvss2_scores(CVE)
+        for errata in erratas:
+            if errata.get('cve'):
+                # Every advisory of the batch is resolved when the batch is
+                self.rhen_metrics.observe('rhen_cve_advisory_seconds', time.time() - start)
+            errata['scores'] = dict((cve, scores.get(cve)) for cve in errata.get('cve', []))
+            cvss2 = [score for score in errata['scores'].values() if score is not None]
+            if cvss2:
+                errata['cvss2'] = max(cvss2)
 
-        for worker in range(self.cfg.getint('processor', 'workers')):
-            t = threading.Thread(target=self.cvss2_consumer, args=((q, cvss2_scores, False)))
-            t.daemon = True
-            t.start()
+    def get_cvss2_score(self, CVE):
+        """ Return max CVSS2 score of CVEs. None if no score could be found."""
+        return max(self.get_cvss2_scores(CVE).values(), default=None)
 
-        self.cvss2_producer(q, CVE)
-        q.join()
+    def find_cvss2_scores(self, CVE):
+        """ Return dict of CVE -> CVSS2 score known without fetching. Imported scores, then cache."""
+        CVE = set(CVE)
+        scores = self.rhen_db.find_imported_cve_scores(CVE) if CVE else dict()
+        self.rhen_metrics.inc('rhen_cve_imported_hits_total', len(scores))
+        scores.update(self.cve_cache.get(CVE - set(scores)))
+        return scores
+
+    def get_cvss2_scores(self, CVE):
+        """ Return dict of CVE -> CVSS2 score. Known scores first, remaining fetched by workers."""
+        start = time.time()
+        scores = self.find_cvss2_scores(CVE)
+        missing = [cve for cve in set(CVE) if cve not in scores]
+        if len(missing) == 0:
+            return scores
+
+        results = self.executor.map(self.fetch_cvss2_score, missing)
+        fetched = [(cve, cvss2) for cve, cvss2 in zip(missing, results) if cvss2 is not None]
         self.logger.debug("Threading timing: " + str(time.time() - start))
-        return max(cvss2_scores)
+        self.cve_cache.put(fetched)
+        scores.update(fetched)
+        return scores
+
+    def fetch_cvss2_score(self, cve):
+        """
+            Load CVE web page and extract the CVSS2 base score.
+            If no score is found, return None and cvss2 is not displayed.
+        """
+        self.rhen_metrics.inc('rhen_cve_requests_total')
+        try:
+            with self.rhen_metrics.timer('rhen_cve_request_seconds'):
+                cvss2 = self.fetch.get(self.cve_base + cve, self.read_cvss2_score, stream=self.stream_cve,
+                                       hedge=True)
+        except RHENExceptions.FetchFailed as err:
+            self.logger.error("Failed fetching %s: %s" % (cve, err))
+            cvss2 = None
+        except Exception as err:
+            # One bad page must never end the poll loop
+            self.logger.error("Failed reading %s: %r" % (cve, err))
+            cvss2 = None
+        if cvss2 is None:
+            self.rhen_metrics.inc('rhen_cve_failures_total')
+        return cvss2
+
+    def read_cvss2_score(self, page):
+        try:
+            if self.stream_cve:
+                return self.stream_cvss2_score(page)
+            return self.parse_cvss2_score(page.text)
+        finally:
+            # Bytes read off the connection, before decompression
+            self.rhen_metrics.inc('rhen_cve_bytes_total', page.raw.tell())
 
-    def cvss2_producer(self, q, CVE):
-        """ Put the CVEs on queue, so consumers can get and process. """
+    def parse_cvss2_score(self, page):
         try:
-            for cve in CVE:
-                q.put(cve)
-        except queue.Full as err:
-            self.logger.error("Queue is full: %s", err)
+            doc = etree.fromstring(page, self.parser)
 
-    def cvss2_consumer(self, q, cvss2_scores, lock=False):
+            # Extrac CVSS2 base score from page
+            return float(doc.xpath("//table/tr[th='Base Score:']/td")[0].text)
+        except (IndexError, ValueError, TypeError, AttributeError, etree.XMLSyntaxError) as err:
+            self.logger.error("Failed parsing CVSS2 base score: %s", err)
+            return None
+
+    def cvss2_pull_parser(self):
+        return etree.XMLPullParser(events=('end',), tag='tr', recover=True)
+
+    def feed_cvss2_score(self, pull, chunk):
+        """ Feed a chunk of a CVE page. Return the CVSS2 base score once its table row is parsed."""
+        pull.feed(chunk)
+        for event, tr in pull.read_events():
+            if tr.getparent().tag == 'table' and tr.findtext('th') == 'Base Score:':
+                try:
+                    return float(tr.findtext('td'))
+                except (TypeError, ValueError) as err:
+                    self.logger.error("Failed parsing CVSS2 base score: %s", err)
+                    return None
+            tr.clear()
+        return None
+
+    def cve_drain_limit(self, headers, read):
         """
-            Get CVE from queue, load CVE web page and extract the CVSS2 base score.
-            Signal producer after finished processing item.
-            If no CVE is found, no entry is added to queue and cvss2 is not displayed.
+            Bytes of a CVE page to read unparsed after the CVSS2 score. A small remainder is
+            drained so the pooled connection is reused, a remainder known to be larger than
+            CVE_DRAIN_LIMIT is dropped by closing the connection.
         """
-        while True:
-            try:
-                cve = q.get()
-                page = requests.get(self.cve_base + cve)
-                doc = etree.fromstring(page.text, self.parser)
-
-                # Extrac CVSS2 base score from page
-                cvss2 = float(doc.xpath("//table/tr[th='Base Score:']/td")[0].text)
-
-                # Append to thread safe queue
-                cvss2_scores.append(cvss2)
-
-            except requests.ConnectionError as err:
-                self.logger.error("Failed connecting: %s", err)
-            except queue.Empty as err:
-                self.logger.error("Queue is empty: %s", err)
-            except IndexError as err:
-                self.logger.error("Failed parsing CVSS2 base score: %s", err)
-            finally:
-                q.task_done()
+        try:
+            if int(headers['Content-Length']) - read > self.CVE_DRAIN_LIMIT:
+                return 0
+        except (KeyError, ValueError):
+            pass
+        return self.CVE_DRAIN_LIMIT
+
+    def stream_cvss2_score(self, page):
+        """
+            Extract the CVSS2 base score from chunks of a CVE page. Stop parsing as soon
+            as the score is found, the rest of the page is drained or never downloaded.
+        """
+        pull = self.cvss2_pull_parser()
+        chunks = page.iter_content(self.CVE_CHUNK_SIZE)
+        for chunk in chunks:
+            cvss2 = self.feed_cvss2_score(pull, chunk)
+            if cvss2 is not None:
+                # The response is closed on exit unless it was read to the end
+                limit = self.cve_drain_limit(page.headers, page.raw.tell())
+                if limit:
+                    for chunk in chunks:
+                        limit -= len(chunk)
+                        if limit < 0:
+                            break
+                return cvss2
+        self.logger.error("Failed parsing CVSS2 base score: no Base Score row")
+        return None
@@ -0,0 +1,290 @@
+"""
+This file is part of Red Hat Errata Notifications (rhen.py).
+Copyright (C) 2015 Espen Hovind <espehov@ifi.uio.no>
+
+rhen.py is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rhen.py is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import collections
+import configparser
+import cProfile
+import fnmatch
+import io
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import requests
+import urllib3
+
+class RHENProfiler(object):
+    """
+        Profile poll cycles with cProfile and tracemalloc. Each cycle writes its
+        cProfile stats and the memory held by each allocation site in modules, and
+        the files of the last keep cycles are kept.
+        Before Python 3.12, threads started after the profiler, such as CVE workers
+        and the dispatcher, are profiled throughout, and a cycle includes what they ran
+        since the last cycle. From 3.12 only one cProfile can be enabled in a process,
+        so only the polling thread is profiled.
+        summary.txt is rewritten after each cycle. It lists the top functions of all
+        cycles so far, and the allocation sites in modules that hold the most memory
+        and that grew the most since the first and the last cycle, with RSS by cycle.
+        Stats files load with pstats.
+    """
+    ELSEWHERE = '(elsewhere)'
+    # cProfile is enabled per thread before Python 3.12, and once per process from 3.12
+    PER_THREAD = sys.version_info < (3, 12)
+
+    def __init__(self, cfg, logger):
+        self.cfg = cfg
+        self.logger = logger
+        self.directory, self.modules, self.top, self.keep, self.frames = self.parse_config()
+        self.patterns = ['*/%s.py' % module for module in self.modules]
+        self.matches = dict()
+        self.cycles = 0
+        self.stats = None
+        self.first = None
+        self.previous = None
+        self.rss = collections.deque(maxlen=self.keep)
+        self.lock = threading.Lock()
+        self.threads = []
+        self.init_directory()
+        tracemalloc.start(self.frames)
+        if self.PER_THREAD:
+            threading.setprofile(self.profile_thread)
+
+    def parse_config(self):
+        try:
+            return (self.cfg.get('profile', 'directory'),
+                    self.cfg.get('profile', 'modules').split(),
+                    self.cfg.getint('profile', 'top'),
+                    self.cfg.getint('profile', 'keep'),
+                    self.cfg.getint('profile', 'frames'))
+        except (configparser.Error, ValueError) as err:
+            self.logger.error("Failed parsing config: %s" % err)
+            raise SystemExit(1)
+
+    def init_directory(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as err:
+            self.logger.error("Failed creating profile directory: %s" % err)
+            raise SystemExit(1)
+
+    def profile_thread(self, frame, event, arg):
+        """ Replace the profile function of a new thread by a cProfile of its own."""
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as err:
+            # Another profiler is active, the thread runs unprofiled
+            self.logger.debug("Not profiling %s: %s" % (threading.current_thread().name, err))
+            return
+        with self.lock:
+            self.threads.append((threading.current_thread(), profile, dict()))
+
+    def thread_stats(self):
+        """ Yield cProfile stats of each thread since the last cycle. Forget threads that ended."""
+        with self.lock:
+            threads = list(self.threads)
+        for i, (thread, profile, previous) in enumerate(threads):
+            # Read while the thread keeps running, snapshot_stats does not disable the profile
+            profile.snapshot_stats()
+            delta = self.delta(profile.stats, previous)
+            if delta:
+                yield RHENStatsDelta(delta)
+            threads[i] = (thread, profile, profile.stats)
+        with self.lock:
+            self.threads = [entry for entry in threads if entry[0].is_alive()] + self.threads[len(threads):]
+
+    def delta(self, stats, previous):
+        """ Return cProfile stats less the stats previous, of the functions called since."""
+        delta = dict()
+        for func, (cc, nc, tt, ct, callers) in stats.items():
+            pcc, pnc, ptt, pct, pcallers = previous.get(func, (0, 0, 0, 0, {}))
+            if nc == pnc:
+                continue
+            delta[func] = (cc - pcc, nc - pnc, tt - ptt, ct - pct,
+                           dict((caller, tuple(count - before for count, before
+                                               in zip(counts, pcallers.get(caller, (0, 0, 0, 0)))))
+                                for caller, counts in callers.items() if counts != pcallers.get(caller)))
+        return delta
+
+    def profile(self, func):
+        """ Call func under cProfile, then write the stats of the cycle and update the summary."""
+        self.cycles += 1
+        profile = cProfile.Profile()
+        start = time.process_time()
+        profile.enable()
+        try:
+            return func()
+        finally:
+            profile.disable()
+            cpu = time.process_time() - start
+            try:
+                self.write_cycle(profile, cpu)
+            except OSError as err:
+                self.logger.error("Failed writing profile of cycle %d: %s" % (self.cycles, err))
+
+    def write_cycle(self, profile, cpu):
+        prefix = os.path.join(self.directory, 'cycle-%06d' % self.cycles)
+        stats = pstats.Stats(profile)
+        for delta in self.thread_stats():
+            stats.add(delta)
+        stats.dump_stats(prefix + '.prof')
+        if self.stats is None:
+            self.stats = pstats.Stats(RHENStatsDelta(dict(stats.stats)))
+        else:
+            self.stats.add(stats)
+
+        sites = self.sites(tracemalloc.take_snapshot())
+        with open(prefix + '.sites', 'wt') as fd:
+            self.write_sites(fd, sites)
+        if self.first is None:
+            self.first = sites
+        self.rss.append((self.cycles, self.current_rss(), tracemalloc.get_traced_memory()[0]))
+
+        with open(os.path.join(self.directory, 'summary.txt'), 'wt') as fd:
+            self.write_summary(fd, sites)
+        self.previous = sites
+        self.remove_cycle(self.cycles - self.keep)
+        self.logger.info("Profiled cycle %d: %.2fs CPU, RSS %d KiB, traced %d KiB" %
+                         (self.cycles, cpu, self.rss[-1][1] // 1024, self.rss[-1][2] // 1024))
+
+    def remove_cycle(self, cycle):
+        for extension in ('.prof', '.sites'):
+            path = os.path.join(self.directory, 'cycle-%06d%s' % (cycle, extension))
+            if os.path.exists(path):
+                os.remove(path)
+
+    def sites(self, snapshot):
+        """
+            Return dict of 'file:line' -> (size, count) of memory held by snapshot, each
+            allocation counted at the innermost line in a profiled module that made it.
+            Allocations without a profiled module in their recorded frames count as ELSEWHERE.
+        """
+        sites = collections.defaultdict(lambda: [0, 0])
+        for statistic in snapshot.statistics('traceback'):
+            site = sites[self.ELSEWHERE]
+            for frame in statistic.traceback:
+                if self.match(frame.filename):
+                    site = sites["%s:%d" % (frame.filename, frame.lineno)]
+                    break
+            site[0] += statistic.size
+            site[1] += statistic.count
+        return dict((site, tuple(held)) for site, held in sites.items())
+
+    def match(self, filename):
+        """ Return True if filename is a profiled module. Snapshot.filter_traces is too slow for every cycle."""
+        matched = self.matches.get(filename)
+        if matched is None:
+            matched = self.matches[filename] = any(fnmatch.fnmatch(filename, pattern)
+                                                   for pattern in self.patterns)
+        return matched
+
+    def growth(self, sites, since):
+        """ Return (site, size diff, count diff) sorted by growth, largest first."""
+        diff = [(site, size - since.get(site, (0, 0))[0], count - since.get(site, (0, 0))[1])
+                for site, (size, count) in sites.items()]
+        diff += [(site, -size, -count) for site, (size, count) in since.items() if site not in sites]
+        diff = [site for site in diff if site[1] or site[2]]
+        return sorted(diff, key=lambda site: site[1], reverse=True)[:self.top]
+
+    def current_rss(self):
+        """ Return resident set size in bytes, or peak RSS where /proc is unavailable."""
+        try:
+            with open('/proc/self/statm') as fd:
+                return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def write_sites(self, fd, sites, top=None):
+        for site, (size, count) in sorted(sites.items(), key=lambda site: site[1][0], reverse=True)[:top]:
+            fd.write("{0:>12d} B {1:>8d} blocks  {2}\n".format(size, count, site))
+
+    def write_summary(self, fd, sites):
+        fd.write("Profiled %d poll cycles, modules: %s\n\n" % (self.cycles, ' '.join(self.modules)))
+        restriction = '|'.join(self.modules)
+        self.stats.stream = fd
+        for order in ('cumulative', 'tottime'):
+            fd.write("Top functions by %s time, all cycles\n" % order)
+            self.stats.sort_stats(order).print_stats(restriction, self.top)
+
+        fd.write("RSS by cycle\n")
+        fd.write("{0:>8s}{1:>14s}{2:>14s}\n".format('cycle', 'RSS KiB', 'traced KiB'))
+        for cycle, rss, traced in self.rss:
+            fd.write("{0:>8d}{1:>14d}{2:>14d}\n".format(cycle, rss // 1024, traced // 1024))
+
+        fd.write("\nMemory held by allocation site\n")
+        self.write_sites(fd, sites, self.top)
+        for title, since in (("first", self.first), ("last", self.previous)):
+            if since is None or self.cycles < 2:
+                continue
+            fd.write("\nGrowth by allocation site since %s cycle\n" % title)
+            for site, size, count in self.growth(sites, since):
+                fd.write("{0:>+12d} B {1:>+8d} blocks  {2}\n".format(size, count, site))
+
+
+class RHENStatsDelta(object):
+    """ cProfile stats of a thread, in the form pstats.Stats loads."""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class RHENReplayAdapter(requests.adapters.BaseAdapter):
+    """
+        Serve requests from a directory mirroring the URLs fetched, as saved by
+        wget --force-directories: <dir>/<host>/<path>. Missing files are 404.
+    """
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+
+    def path(self, url):
+        url = urllib.parse.urlsplit(url)
+        path = os.path.join(self.directory, url.netloc, urllib.parse.unquote(url.path).lstrip('/'))
+        if url.query:
+            path += '?' + url.query
+        if os.path.isdir(path):
+            path = os.path.join(path, 'index.html')
+        return path
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        try:
+            with open(self.path(request.url), 'rb') as fd:
+                body = fd.read()
+            response.status_code = 200
+            response.reason = 'OK'
+        except OSError:
+            body = b''
+            response.status_code = 404
+            response.reason = 'Not Found'
+        response.headers = requests.structures.CaseInsensitiveDict({'Content-Length': str(len(body))})
+        response.raw = urllib3.HTTPResponse(io.BytesIO(body), headers=response.headers,
+                                            status=response.status_code, preload_content=False)
+        return response
+
+    def close(self):
+        pass
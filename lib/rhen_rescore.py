@@ -0,0 +1,140 @@
+"""
+This file is part of Red Hat Errata Notifications (rhen.py).
+Copyright (C) 2015 Espen Hovind <espehov@ifi.uio.no>
+
+rhen.py is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+rhen.py is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import configparser
+import datetime
+import time
+from concurrent import futures
+
+import lib.rhen_exceptions as RHENExceptions
+
+class RHENRescore(object):
+    """
+        Retry scoring of security advisories stored without CVEs, or with CVEs whose
+        score could not be found. Queued advisories are retried in the idle time
+        between polls, most severe and newest first, batch_size at a time with at most
+        concurrency CVE pages fetched at once. Failed retries back off exponentially.
+    """
+    def __init__(self, cfg, logger, rhen_db, rhen_parser, rhen_metrics):
+        self.cfg = cfg
+        self.logger = logger
+        self.rhen_db = rhen_db
+        self.rhen_parser = rhen_parser
+        self.rhen_metrics = rhen_metrics
+        (self.errata_details, self.batch_size, self.concurrency, self.backoff,
+         self.max_backoff, self.max_attempts) = self.parse_config()
+        self.executor = self.init_executor()
+
+    def parse_config(self):
+        try:
+            return (self.cfg.get('rescore', 'errata_details'),
+                    self.cfg.getint('rescore', 'batch_size'),
+                    self.cfg.getint('rescore', 'concurrency'),
+                    self.cfg.getint('rescore', 'backoff'),
+                    self.cfg.getint('rescore', 'max_backoff'),
+                    self.cfg.getint('rescore', 'max_attempts'))
+        except (configparser.Error, ValueError) as err:
+            self.logger.error("Failed parsing config: %s" % err)
+            raise SystemExit(1)
+
+    def init_executor(self):
+        return futures.ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='rescore')
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.rhen_parser.shutdown()
+
+    def run(self, deadline, stopped):
+        """
+            Retry queued advisories until the queue has nothing due, deadline (a time.time())
+            passes or stopped is set. Return True if due advisories are left. Return False if
+            storing scores fails, so the same batch is not fetched again until the next check.
+        """
+        self.rhen_parser.fetch.start_cycle(deadline - time.time())
+        try:
+            while not stopped.is_set() and time.time() < deadline:
+                queued = self.rhen_db.find_rescore(self.batch_size)
+                if not queued:
+                    return False
+                self.rescore(queued)
+            return True
+        except RHENExceptions.RescoreFailed as err:
+            self.logger.error("Stopped rescoring: %s" % err)
+            return False
+        finally:
+            self.rhen_metrics.set('rhen_rescore_queue_depth', self.rhen_db.count_rescore())
+
+    def rescore(self, queued):
+        """ Look up the missing CVE scores of a batch of (advisory, link, attempts) in one pass."""
+        advisories = dict((advisory, self.rhen_db.find_advisory_scores(advisory))
+                          for advisory, link, attempts in queued)
+
+        # Advisories without stored CVEs get them from their errata page
+        unknown = [(advisory, link) for advisory, link, attempts in queued if not advisories[advisory]]
+        for (advisory, link), CVE in zip(unknown, self.executor.map(self.fetch_errata_cves, unknown)):
+            advisories[advisory] = dict((cve, None) for cve in CVE)
+
+        CVE = set(cve for scores in advisories.values() for cve, cvss2 in scores.items() if cvss2 is None)
+        scores = self.get_cvss2_scores(CVE)
+
+        expired = self.rhen_parser.fetch.expired()
+        for advisory, link, attempts in queued:
+            advisory_scores = dict((cve, cvss2 if cvss2 is not None else scores.get(cve))
+                                   for cve, cvss2 in advisories[advisory].items())
+            if expired and not self.scored(advisory_scores):
+                # Its fetches may have been refused by the deadline, that is no failed attempt
+                continue
+            next_attempt = self.next_attempt(advisory, advisory_scores, attempts)
+            self.rhen_db.update_rescore(advisory, advisory_scores, next_attempt)
+            self.rhen_metrics.inc('rhen_rescore_attempts_total')
+            if self.scored(advisory_scores):
+                self.logger.info("Rescored %s: %s" % (advisory, max(advisory_scores.values())))
+                self.rhen_metrics.inc('rhen_rescored_total')
+
+    def scored(self, scores):
+        return bool(scores) and None not in scores.values()
+
+    def next_attempt(self, advisory, scores, attempts):
+        """ Return when to retry advisory, or None if it is scored or given up."""
+        if self.scored(scores):
+            return None
+        if self.max_attempts and attempts + 1 >= self.max_attempts:
+            self.logger.error("Giving up scoring %s after %d attempts" % (advisory, attempts + 1))
+            return None
+        delay = min(self.max_backoff, self.backoff * 2 ** attempts)
+        self.logger.debug("Retrying score of %s in %ds" % (advisory, delay))
+        return datetime.datetime.now() + datetime.timedelta(seconds=delay)
+
+    def get_cvss2_scores(self, CVE):
+        """ Return dict of CVE -> CVSS2 score. Known scores first, remaining fetched concurrently."""
+        scores = self.rhen_parser.find_cvss2_scores(CVE)
+        missing = [cve for cve in CVE if cve not in scores]
+        results = self.executor.map(self.rhen_parser.fetch_cvss2_score, missing)
+        fetched = [(cve, cvss2) for cve, cvss2 in zip(missing, results) if cvss2 is not None]
+        self.rhen_parser.cve_cache.put(fetched)
+        scores.update(fetched)
+        return scores
+
+    def fetch_errata_cves(self, queued):
+        """ Return CVEs listed on the errata page of a queued (advisory, link). Empty list if none found."""
+        advisory, link = queued
+        try:
+            return self.rhen_parser.fetch.get(link or self.errata_details + advisory,
+                                              lambda page: sorted(set(self.rhen_parser.parse_errata_cve(page.text))))
+        except RHENExceptions.FetchFailed as err:
+            self.logger.error("Failed fetching errata page of %s: %s" % (advisory, err))
+            return []
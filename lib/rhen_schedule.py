@@ -15,47 +15,103 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
 """
-import sched
+import random
+import threading
 import time
 import configparser
 
 class RHENSchedule(object):
+    """
+        Flat scheduling loop. Checks run at a fixed rate from the previous scheduled
+        time, with jitter. The interval shrinks while the feed keeps changing and grows
+        while it does not. Failed checks back off exponentially.
+        Wall clock time is used, so checks missed during a suspend are caught up once.
+    """
+    # Longest single sleep, so a suspend or clock change is noticed quickly
+    WAIT_STEP = 60
+    # Idle work stops this long before the next check
+    IDLE_MARGIN = 5
+
     def __init__(self, cfg, logger):
         self.cfg = cfg
         self.logger = logger
-        self.event_id = None
-        self.check_interval = self.parse_config()
-        self.scheduler = self.init_scheduler()
+        (self.check_interval, self.min_interval, self.max_interval,
+         self.jitter, self.max_backoff) = self.parse_config()
+        self.interval = self.check_interval
+        self.failures = 0
+        self.cadence = None
+        self.next_check = None
+        self.stopped = threading.Event()
 
     def parse_config(self):
         try:
-            return self.cfg.getint('notfications', 'check_errata_interval')
-        except configparser.Error as err:
+            check_interval = self.cfg.getint('notfications', 'check_errata_interval')
+            min_interval = self.cfg.getint('notfications', 'min_errata_interval', fallback=check_interval)
+            max_interval = self.cfg.getint('notfications', 'max_errata_interval', fallback=check_interval)
+            jitter = self.cfg.getfloat('notfications', 'jitter', fallback=0.0)
+            max_backoff = self.cfg.getint('notfications', 'max_backoff', fallback=max_interval)
+            return (check_interval, min_interval, max_interval, jitter, max_backoff)
+        except (configparser.Error, ValueError) as err:
             self.logger.error("Failed parsing config: %s" % err)
             raise SystemExit(1)
 
-    def init_scheduler(self):
-        return sched.scheduler(time.time, time.sleep)
+    def run(self, func, idle=None):
+        """
+            Call func at every scheduled check until cancelled. First check runs at once.
+            Between checks, call idle(deadline, stopped) until it returns False, meaning
+            it has no work left before the next check.
+        """
+        self.cadence = self.next_check = time.time()
+        while self.wait(idle):
+            func()
+            self.schedule_next()
+            self.logger.debug("Scheduled new check: %s" % time.ctime(self.next_check))
 
-    def next_check_errata(self, func):
-        self._event_id = self.scheduler.enter(self.check_interval, 1, func)
-        self.logger.debug("Scheduled new check: %s", self._event_id)
-        self.scheduler.run()
+    def wait(self, idle=None):
+        """ Sleep until next check, doing idle work first. Return False if cancelled."""
+        busy = idle is not None
+        while not self.stopped.is_set():
+            remaining = self.next_check - time.time()
+            if remaining <= 0:
+                return True
+            if busy and remaining > self.IDLE_MARGIN:
+                busy = idle(self.next_check - self.IDLE_MARGIN, self.stopped)
+                continue
+            self.stopped.wait(min(remaining, self.WAIT_STEP))
+        return False
 
-    def cancel_check_errata(self):
-        if self.event_id:
-            self.scheduler.cancel(self.event_id)
+    def schedule_next(self):
+        now = time.time()
+        if self.failures:
+            delay = min(self.max_backoff, self.interval * 2 ** self.failures)
+            self.cadence = now + delay
+        else:
+            self.cadence += self.interval
+            if self.cadence < now:
+                missed = int((now - self.cadence) // self.interval) + 1
+                self.logger.info("Missed %d checks, catching up" % missed)
+                self.cadence = now
+        # Jitter is applied around the cadence, so it never accumulates
+        self.next_check = self.cadence + random.uniform(-self.jitter, self.jitter) * self.interval
 
-    @property
-    def event_id(self):
-        return self._event_id
+    def succeeded(self, changed):
+        """ Adapt interval to how often the feed changes."""
+        self.failures = 0
+        if changed:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+        self.logger.debug("Check interval: %ds" % self.interval)
 
-    @event_id.setter
-    def event_id(self, event_id):
-        self._event_id = event_id
+    def failed(self):
+        self.failures += 1
+        self.logger.info("Backing off after %d failed checks" % self.failures)
+
+    def cancel_check_errata(self):
+        self.stopped.set()
 
     def __repr__(self):
-        return "RHENSchedule ({0.cfg!r}, {0.logger!r}, {0.event_id!r})".format(self)
+        return "RHENSchedule ({0.cfg!r}, {0.logger!r}, {0.next_check!r})".format(self)
 
     def __str__(self):
-        return "str({0.cfg!s}, {0.logger!s}, {0.event_id!s})".format(self)
+        return "str({0.cfg!s}, {0.logger!s}, {0.next_check!s})".format(self)
@@ -19,44 +19,139 @@ along with rhen.py.  If not, see <http://www.gnu.org/licenses/>.
 import logging
 import logging.config
 import configparser
+import contextlib
+import functools
 import os
+import shutil
 import signal
 import argparse
 import atexit
 import sys
+import tempfile
+import time
+import datetime
 
-from lib.rhen_dbus import RHENDbus
-from lib.rhen_db import RHENdb
-from lib.rhen_parser import RHENParser
-from lib.rhen_schedule import RHENSchedule
 import lib.rhen_exceptions as RHENExceptions
 
+STARTED = time.perf_counter()
+
+def subsystem(name):
+    """ Subsystem built by init_<name> on first use, so each mode only loads what it needs """
+    def init(self):
+        with self.startup_timer('init', name):
+            return getattr(self, 'init_' + name)()
+    return functools.cached_property(init)
+
 class RedHatErrataNotify(object):
     CONFIG = os.getcwd() + '/config/rhen.ini'
     CONFIG_LOG = os.getcwd() + '/config/rhen-log.ini'
+    # Longest wait for the notifications of a replayed cycle
+    REPLAY_DRAIN = 60
+
+    rhen_metrics = subsystem('metrics')
+    rhen_schedule = subsystem('schedule')
+    rhen_db = subsystem('db')
+    rhen_dbus = subsystem('dbus')
+    rhen_dispatcher = subsystem('dispatcher')
+    rhen_parser = subsystem('parser')
+    rhen_hub_client = subsystem('hub_client')
+    rhen_rescore = subsystem('rescore')
+    rhen_profiler = subsystem('profiler')
 
     def __init__(self, args):
         self.args = args
-        self.cfg = self.read_config()
-        self.logger = self.setup_logging()
+        self.startup = []
+        self.startup_nested = []
+        with self.startup_timer('init', 'config'):
+            self.cfg = self.read_config()
+            self.logger = self.setup_logging()
         signal.signal(signal.SIGINT, self.cleanup)
 
-        self.rhen_schedule = self.init_schedule()
-        self.rhen_dbus = self.init_dbus()
-        self.rhen_db = self.init_db()
-        self.rhen_parser = self.init_parser()
+    def init_metrics(self):
+        with self.startup_timer('import', 'metrics'):
+            from lib.rhen_metrics import RHENMetrics
+        return RHENMetrics(self.cfg, self.logger)
 
     def init_schedule(self):
+        with self.startup_timer('import', 'schedule'):
+            from lib.rhen_schedule import RHENSchedule
         return RHENSchedule(self.cfg, self.logger)
 
     def init_dbus(self):
+        with self.startup_timer('import', 'dbus'):
+            from lib.rhen_dbus import RHENDbus
         return RHENDbus(self.cfg, self.logger)
 
+    def init_dispatcher(self):
+        # The hub publishes to subscribers, it never notifies itself
+        if self.args['hub']:
+            with self.startup_timer('import', 'hub'):
+                from lib.rhen_hub import RHENHub
+            return RHENHub(self.cfg, self.logger, self.rhen_db, self.rhen_metrics)
+        with self.startup_timer('import', 'dispatcher'):
+            from lib.rhen_dispatch import RHENDispatcher
+        return RHENDispatcher(self.cfg, self.logger, self.rhen_dbus, self.rhen_metrics)
+
     def init_db(self):
+        with self.startup_timer('import', 'db'):
+            from lib.rhen_db import RHENdb
         return RHENdb(self.cfg, self.logger)
 
+    def init_hub_client(self):
+        with self.startup_timer('import', 'hub_client'):
+            from lib.rhen_hub import RHENHubClient
+        return RHENHubClient(self.cfg, self.logger, self.rhen_dispatcher)
+
     def init_parser(self):
-        return RHENParser(self.cfg, self.logger, self.rhen_db, self.rhen_dbus)
+        if self.cfg.get('processor', 'engine', fallback='threads') == 'asyncio':
+            with self.startup_timer('import', 'parser'):
+                from lib.rhen_async_parser import RHENAsyncParser
+            return RHENAsyncParser(self.cfg, self.logger, self.rhen_db, self.rhen_dispatcher,
+                                   self.rhen_metrics)
+        with self.startup_timer('import', 'parser'):
+            from lib.rhen_parser import RHENParser
+        return RHENParser(self.cfg, self.logger, self.rhen_db, self.rhen_dispatcher, self.rhen_metrics)
+
+    def init_rescore(self):
+        with self.startup_timer('import', 'rescore'):
+            from lib.rhen_rescore import RHENRescore
+            from lib.rhen_parser import RHENParser
+        # Retries run on the thread engine between polls, whatever engine polls
+        rhen_parser = RHENParser(self.cfg, self.logger, self.rhen_db, None, self.rhen_metrics)
+        return RHENRescore(self.cfg, self.logger, self.rhen_db, rhen_parser, self.rhen_metrics)
+
+    def init_profiler(self):
+        with self.startup_timer('import', 'profiler'):
+            from lib.rhen_profile import RHENProfiler
+        return RHENProfiler(self.cfg, self.logger)
+
+    def initialized(self, name):
+        return name in self.__dict__
+
+    @contextlib.contextmanager
+    def startup_timer(self, phase, name):
+        """ Time a startup step, excluding the steps nested in it """
+        self.startup_nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self.startup_nested.pop()
+            if self.startup_nested:
+                self.startup_nested[-1] += elapsed
+            self.startup.append((phase, name, elapsed - nested))
+
+    def report_startup(self):
+        """ Log time since rhen.py started, with the import and init time of each subsystem loaded """
+        total = time.perf_counter() - STARTED
+        steps = ', '.join("%s %s %.1f ms" % (phase, name, elapsed * 1000)
+                          for phase, name, elapsed in self.startup)
+        self.logger.debug("Started in %.1f ms: %s" % (total * 1000, steps))
+        if self.args['startup_report']:
+            sys.stderr.write("Started in %.1f ms\n" % (total * 1000))
+            for phase, name, elapsed in self.startup:
+                sys.stderr.write("  {0:<8s}{1:<12s}{2:>8.1f} ms\n".format(phase, name, elapsed * 1000))
 
     def setup_logging(self):
         logging.config.fileConfig(self.CONFIG_LOG)
@@ -76,32 +171,151 @@ class RedHatErrataNotify(object):
             self.logger.error("Failed reading config file: %s" % err)
             raise SystemExit(1)
 
+    def start(self):
+        """ Check for erratas now, and then on schedule until stopped."""
+        # Before any thread starts, so every thread is profiled
+        if self.args['profile'] and not self.args['subscribe']:
+            self.rhen_profiler
+        self.rhen_metrics.start()
+        if self.args['subscribe']:
+            self.rhen_hub_client
+            self.report_startup()
+            self.rhen_hub_client.run()
+        else:
+            # Fail on a missing session bus or bad config now, not at the first check
+            self.rhen_parser
+            self.rhen_rescore
+            self.report_startup()
+            self.rhen_schedule.run(self.poll, self.rhen_rescore.run)
+
+    def poll(self):
+        """ Run a poll cycle, profiled with --profile """
+        if self.args['profile']:
+            self.rhen_profiler.profile(self.run)
+        else:
+            self.run()
+
     def run(self):
         """
         Load RSS feed and compare with already seen erratas.
         If new errata, send notification and store in db.
-        Schedule a new errata check.
+        Adapt the schedule to whether the feed changed, or back off on failure.
         """
         self.logger.info("Parsing erratas")
+        self.rhen_metrics.inc('rhen_poll_cycles_total')
+        start = time.time()
 
         try:
-            self.rhen_parser.parse_errata()
+            changed = self.rhen_parser.parse_errata()
+            self.rhen_schedule.succeeded(changed)
         except RHENExceptions.ParseErrataFailed as err:
             self.logger.error("Failed parsing errata: %s" % err)
+            self.rhen_metrics.inc('rhen_poll_failures_total')
+            self.rhen_schedule.failed()
         finally:
-            self.rhen_schedule.next_check_errata(self.run)
-
-    def list_erratas(self, category):
-        """ List all erratas in category """
-        erratas_all = self.rhen_db.list_all()
-        erratas = [errata for errata in erratas_all if errata[0].startswith(category)]
-        for errata in erratas:
+            self.rhen_metrics.observe('rhen_poll_cycle_seconds', time.time() - start)
+            self.rhen_metrics.set('rhen_poll_cycle_last_seconds', time.time() - start)
+            self.rhen_metrics.set('rhen_check_interval_seconds', self.rhen_schedule.interval)
+            self.rhen_metrics.write_textfile()
+
+    def list_erratas(self, category, since=None, min_cvss=None, limit=None):
+        """ List erratas in category, newest first """
+        for errata in self.rhen_db.list_erratas(category, since, min_cvss, limit):
             print("{advisory:<16s}{cvss2:<5}{synopsis:<64s}{date:16s}".format(advisory=errata[0],
-            cvss2=errata[2], synopsis=errata[1], date=errata[3].strftime('%Y-%m-%d %H:%M:%S')))
+            cvss2=errata[2] if errata[2] is not None else '', synopsis=errata[1],
+            date=errata[3].strftime('%Y-%m-%d %H:%M:%S')))
+
+    def list_advisory_cves(self, cve=None, min_score=None, limit=None):
+        """ List advisories fixing CVE, or CVEs with at least min_score, highest score first """
+        for row in self.rhen_db.list_advisory_cves(cve, min_score, limit):
+            print("{advisory:<16s}{cve:<16s}{cvss2:<5}{synopsis:<64s}{date:16s}".format(advisory=row[0],
+            cve=row[1], cvss2=row[2] if row[2] is not None else '', synopsis=row[3],
+            date=row[4].strftime('%Y-%m-%d %H:%M:%S')))
+
+    def recompute_scores(self):
+        """ Recompute advisory scores from stored CVE scores """
+        print("Updated CVSS2 score of %d erratas" % self.rhen_db.recompute_scores())
+
+    def import_cve(self, paths):
+        """ Import CVE scores from bulk data files, used before scraping CVE pages """
+        from lib.rhen_import import RHENCveImport
+        rhen_import = RHENCveImport(self.cfg, self.logger, self.rhen_db)
+        for path in paths:
+            try:
+                print("Imported %d CVE scores from %s" % (rhen_import.import_file(path), path))
+            except RHENExceptions.ImportFailed as err:
+                sys.stderr.write("Failed importing %s: %s\n" % (path, err))
+                raise SystemExit(1)
+        # Imported scores may revise the scores of stored advisories
+        self.recompute_scores()
+
+    def backfill(self, path):
+        """ Store erratas from archived RSS dumps, without notifications """
+        from lib.rhen_backfill import RHENBackfill
+        from lib.rhen_parser import RHENParser
+        # CVE lookups of a batch run on the thread engine, whatever engine polls
+        rhen_parser = RHENParser(self.cfg, self.logger, self.rhen_db, None, self.rhen_metrics)
+        try:
+            print("Backfilled %d erratas from %s" % (RHENBackfill(self.cfg, self.logger, self.rhen_db,
+                                                                  rhen_parser).run(path), path))
+        except RHENExceptions.ImportFailed as err:
+            sys.stderr.write("Failed backfilling %s: %s\n" % (path, err))
+            raise SystemExit(1)
+        finally:
+            rhen_parser.shutdown()
+
+    def replay(self, path):
+        """
+        Run one poll cycle on feeds and CVE pages saved in path, instead of fetching them.
+        Erratas are stored in a scratch db, which is removed afterwards.
+        """
+        from lib.rhen_profile import RHENReplayAdapter
+        scratch = tempfile.mkdtemp(prefix='rhen-replay-')
+        self.cfg.set('db', 'path', os.path.join(scratch, 'erratas.db'))
+        # The saved pages are served to the requests session of the thread engine
+        self.cfg.set('processor', 'engine', 'threads')
+        self.cfg.set('metrics', 'textfile', '')
+        try:
+            if self.args['profile']:
+                self.rhen_profiler
+            adapter = RHENReplayAdapter(path)
+            self.rhen_parser.session.mount('http://', adapter)
+            self.rhen_parser.session.mount('https://', adapter)
+            self.report_startup()
+            if self.args['profile']:
+                self.rhen_profiler.profile(self.replay_cycle)
+            else:
+                self.replay_cycle()
+        finally:
+            if self.initialized('rhen_parser'):
+                self.rhen_parser.shutdown()
+            if self.initialized('rhen_dispatcher'):
+                self.rhen_dispatcher.shutdown()
+            if self.initialized('rhen_db'):
+                self.rhen_db.close()
+            shutil.rmtree(scratch)
+
+    def replay_cycle(self):
+        self.run()
+        # Notifications are part of the cycle, wait until they are sent
+        if not self.rhen_dispatcher.drain(self.REPLAY_DRAIN):
+            self.logger.error("Notifications still pending after %ds" % self.REPLAY_DRAIN)
 
     def cleanup(self, signo, frame):
         print("Cleaning up")
-        self.rhen_schedule.cancel_check_errata()
+        # Only shut down what this mode started
+        if self.initialized('rhen_schedule'):
+            self.rhen_schedule.cancel_check_errata()
+        if self.initialized('rhen_hub_client'):
+            self.rhen_hub_client.shutdown()
+        if self.initialized('rhen_parser'):
+            self.rhen_parser.shutdown()
+        if self.initialized('rhen_rescore'):
+            self.rhen_rescore.shutdown()
+        if self.initialized('rhen_dispatcher'):
+            self.rhen_dispatcher.shutdown()
+        if self.initialized('rhen_metrics'):
+            self.rhen_metrics.shutdown()
         raise SystemExit(0)
 
 def launch_daemon(pid='tmp/rhen.pid', stdin='/dev/null', stdout='/dev/null', stderr='/dev/null'):
@@ -145,19 +359,68 @@ def parse_args():
 
     parser.add_argument("--mode", choices=['daemon-start', 'daemon-stop', 'fg'], default='fg',
             help="Start RHEN in daemon or foreground (default: fg")
+    hub = parser.add_mutually_exclusive_group()
+    hub.add_argument("--hub", action='store_true',
+            help="Fetch erratas for many users, and publish them to subscribers instead of notifying.")
+    hub.add_argument("--subscribe", action='store_true',
+            help="Notify erratas published by a hub, instead of fetching them.")
+    hub.add_argument("--replay", metavar='DIR',
+            help="Run one poll cycle on feeds and CVE pages saved in DIR as <host>/<path>, with a scratch db.")
     parser.add_argument("--list", choices=['RHSA', 'RHBA', 'RHEA'], help="List erratas.")
+    parser.add_argument("--since", type=lambda date: datetime.datetime.strptime(date, '%Y-%m-%d'),
+            help="List erratas added on or after date (YYYY-MM-DD).")
+    parser.add_argument("--min-cvss", type=float, help="List erratas with CVSS2 score of at least this.")
+    parser.add_argument("--limit", type=int, help="List at most this many erratas.")
+    parser.add_argument("--import-cve", nargs='+', metavar='FILE',
+            help="Import CVE scores from NVD JSON or CSV (cve,cvss2,cvss3) files, optionally gzipped.")
+    parser.add_argument("--backfill", metavar='PATH',
+            help="Store erratas from an archived RSS dump, or a directory of dumps. Resumes if interrupted.")
+    parser.add_argument("--cve", metavar='CVE', help="List advisories fixing CVE.")
+    parser.add_argument("--cve-min-score", type=float, metavar='SCORE',
+            help="List advisories fixing CVEs with CVSS2 score of at least this.")
+    parser.add_argument("--recompute-scores", action='store_true',
+            help="Recompute advisory scores from stored CVE scores, without fetching.")
+    parser.add_argument("--profile", action='store_true',
+            help="Profile CPU time and memory allocations of each poll cycle, see [profile] in config.")
+    parser.add_argument("--startup-report", action='store_true',
+            help="Print time spent importing and initializing each subsystem at startup.")
     parser.add_argument("--verbose", action='store_true', help="Display extra information.")
     parser.add_argument("--debug", action='store_true', help="Display debug information.")
 
-    return vars(parser.parse_args())
+    args = parser.parse_args()
+    # Without the command they filter, these would start the daemon
+    if (args.since or args.min_cvss is not None) and not args.list:
+        parser.error("--since and --min-cvss require --list")
+    if args.limit is not None and not (args.list or args.cve or args.cve_min_score is not None):
+        parser.error("--limit requires --list, --cve or --cve-min-score")
+    return vars(args)
 
 def main(args):
     red_hat_errata_notify = RedHatErrataNotify(args)
 
-    if args['list']:
-        red_hat_errata_notify.list_erratas(args['list'])
+    if args['replay']:
+        red_hat_errata_notify.replay(args['replay'])
+        return
+
+    if not (args['import_cve'] or args['backfill'] or args['recompute_scores'] or args['cve'] or
+            args['cve_min_score'] is not None or args['list']):
+        red_hat_errata_notify.start()
+        return
+
+    # Every other command only needs the db, never D-Bus or the network stack
+    red_hat_errata_notify.rhen_db
+    red_hat_errata_notify.report_startup()
+
+    if args['import_cve']:
+        red_hat_errata_notify.import_cve(args['import_cve'])
+    elif args['backfill']:
+        red_hat_errata_notify.backfill(args['backfill'])
+    elif args['recompute_scores']:
+        red_hat_errata_notify.recompute_scores()
+    elif args['cve'] or args['cve_min_score'] is not None:
+        red_hat_errata_notify.list_advisory_cves(args['cve'], args['cve_min_score'], args['limit'])
     else:
-        red_hat_errata_notify.run()
+        red_hat_errata_notify.list_erratas(args['list'], args['since'], args['min_cvss'], args['limit'])
 
 if __name__ == '__main__':
     pid_file = 'tmp/rhen.pid'